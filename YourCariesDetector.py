@@ -1,35 +1,48 @@
 import sys
-import pandas as pd
+from backends import BACKEND, DEFAULT_SERVER_URL, INFERENCE_SERVER
+from modelmanager import MODEL_PATH, ModelManager, startup_timer
 from PySide6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton,
     QComboBox, QSpinBox, QTextEdit, QMessageBox, QStackedWidget,
-    QFileDialog, QTableWidget, QTableWidgetItem, QHBoxLayout, QSizePolicy, QSpacerItem
+    QFileDialog, QTableWidget, QTableWidgetItem, QHBoxLayout, QSizePolicy, QSpacerItem,
+    QProgressBar, QCheckBox, QDialog
 )
-from PySide6.QtCore import QDate, Qt, QTimer
-from PySide6.QtGui import QPixmap, QImage
+from PySide6.QtCore import QDate, Qt, QTimer, Signal
+from PySide6.QtGui import QKeySequence, QPixmap, QShortcut
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2
-from ultralytics import YOLO
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-
-EXCEL_FILE = "caries_patients.xlsx"
-model = YOLO(r"C:\Users\muham\Documents\software_development\best.pt")
-
-def save_patient_data_excel(data):
-    new_data = pd.DataFrame([data])
-    if os.path.exists(EXCEL_FILE):
-        existing_data = pd.read_excel(EXCEL_FILE)
-        updated_data = pd.concat([existing_data, new_data], ignore_index=True)
-        updated_data.to_excel(EXCEL_FILE, index=False)
-    else:
-        new_data.to_excel(EXCEL_FILE, index=False)
+from detectionstore import CLASSES, DetectionStore
+from imageimport import ImageLoader
+from inferencecache import InferenceCache
+from mediafiles import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, list_images
+from patientstore import ANALYTICS_DIMENSIONS, EXCEL_FILE, current_periods, open_patient_store
+from perfmetrics import PERF_ENABLED, PERF_OVERLAY, format_overlay, perf
+from pipeline import PLAYBACK_MODE, FramePipeline, VideoAnalysisWorker
+from recorder import Recorder
+from report import REPORT_FORMATS, render_chart, render_report
+from tiling import TILED_MODES, TiledDetector
+
+# Client mode: frames go to a shared inference server instead of a local model
+model = ModelManager(INFERENCE_SERVER, "remote") if INFERENCE_SERVER else ModelManager()
+patient_store = open_patient_store()
+# Charts and reports are drawn off the GUI thread, on one reused Agg renderer
+report_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report")
+IMAGE_FILTER = f"Image Files ({' '.join('*' + ext for ext in IMAGE_EXTENSIONS)})"
+VIDEO_FILTER = f"Video Files ({' '.join('*' + ext for ext in VIDEO_EXTENSIONS)})"
+
+startup_timer.mark("imports")
+
+def save_patient_data(data):
+    return patient_store.add_visit(data)
 
 class HomePage(QWidget):
     def __init__(self, stacked_widget):
         super().__init__()
         self.stacked_widget = stacked_widget
         self.patient_data = {}
+        self.visit_id = None
         layout = QVBoxLayout()
 
         title_label = QLabel("🦷 Your Caries Detector")
@@ -75,9 +88,23 @@ class HomePage(QWidget):
         next_button = QPushButton("Next")
         next_button.clicked.connect(self.check_fields)
         layout.addWidget(next_button)
+
+        export_button = QPushButton("📤 Export Patients to Excel")
+        export_button.clicked.connect(self.export_patients)
+        layout.addWidget(export_button)
+
+        analytics_button = QPushButton("📈 Clinic Analytics")
+        analytics_button.clicked.connect(lambda: AnalyticsDialog(self).exec())
+        layout.addWidget(analytics_button)
         
         self.setLayout(layout)
 
+    def export_patients(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Patients", EXCEL_FILE, "Excel Files (*.xlsx)")
+        if file_path:
+            count = patient_store.export_xlsx(file_path)
+            QMessageBox.information(self, "Exported", f"{count} patient visits exported to {file_path}")
+
     def check_fields(self):
         if (self.name_edit.text() and
             self.gender_combo.currentIndex() != 0 and
@@ -95,26 +122,83 @@ class HomePage(QWidget):
                 "Last Dental Appointment": self.dental_combo.currentText(),
                 "Notes": self.notes_edit.toPlainText()
             }
-            save_patient_data_excel(self.patient_data)
-            QMessageBox.information(self, "Success", "Patient data saved to Excel! Proceeding to Screening.")
+            self.visit_id = save_patient_data(self.patient_data)
+            QMessageBox.information(self, "Success", "Patient data saved! Proceeding to Screening.")
             self.stacked_widget.analyzing_page.patient_data = self.patient_data
+            self.stacked_widget.analyzing_page.visit_id = self.visit_id
             self.stacked_widget.setCurrentIndex(1)
         else:
             QMessageBox.warning(self, "Incomplete", "Please fill in all required fields.")
 
+class AnalyticsDialog(QDialog):
+    # Class distribution across all analyzed visits, broken down by one patient
+    # field, read from the rollups the patient store keeps up to date on every save
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Clinic Analytics")
+        self.resize(800, 450)
+        layout = QVBoxLayout(self)
+
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel("Period:"))
+        self.period_combo = QComboBox()
+        current = current_periods()
+        named = {current["quarter"]: "This quarter", current["month"]: "This month", current["year"]: "This year",
+                 "all": "All time"}
+        for period in ["all", current["quarter"], current["month"], current["year"]]:
+            self.period_combo.addItem(named[period], period)
+        for period in patient_store.analytics_periods():
+            if self.period_combo.findData(period) < 0:
+                self.period_combo.addItem(period, period)
+        controls.addWidget(self.period_combo)
+        controls.addWidget(QLabel("By:"))
+        self.dimension_combo = QComboBox()
+        for dimension, label in ANALYTICS_DIMENSIONS:
+            self.dimension_combo.addItem(label, dimension)
+        controls.addWidget(self.dimension_combo)
+        controls.addStretch()
+        layout.addLayout(controls)
+
+        self.table = QTableWidget(0, len(CLASSES) + 2)
+        self.table.setHorizontalHeaderLabels(["Group", "Visits"] + CLASSES)
+        layout.addWidget(self.table)
+        self.period_combo.currentIndexChanged.connect(self.refresh)
+        self.dimension_combo.currentIndexChanged.connect(self.refresh)
+        self.refresh()
+
+    def refresh(self):
+        rows = patient_store.analytics(self.period_combo.currentData(), self.dimension_combo.currentData())
+        self.table.setRowCount(len(rows))
+        for i, (value, row) in enumerate(sorted(rows.items())):
+            total = sum(row["counts"].values()) or 1
+            self.table.setItem(i, 0, QTableWidgetItem("All visits" if value == "all" else value))
+            self.table.setItem(i, 1, QTableWidgetItem(str(row["visits"])))
+            for j, cls in enumerate(CLASSES):
+                count = row["counts"][cls]
+                self.table.setItem(i, j + 2, QTableWidgetItem(f"{count} ({count / total * 100:.0f}%)"))
+        self.table.resizeColumnsToContents()
+
 class AnalyzingPage(QWidget):
+    model_state_changed = Signal(str)
+
     def __init__(self, stacked_widget):
         super().__init__()
         self.stacked_widget = stacked_widget
-        self.detection_results = []
+        self.detection_store = DetectionStore(model.names)
         self.cap = None
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
+        self.pipeline = None
+        self.analysis_worker = None
+        self.inference_cache = None
+        self.image_loader = None
+        self.image_index = 0
+        self.image_load_started = 0
+        self.notify_loaded = False
         self.paused = False
         self.mode = None
         self.recording = False
-        self.video_writer = None
+        self.recorder = None
         self.patient_data = {}
+        self.visit_id = None
 
         main_layout = QVBoxLayout()
         main_layout.setAlignment(Qt.AlignCenter)
@@ -125,12 +209,49 @@ class AnalyzingPage(QWidget):
         title_label.setAlignment(Qt.AlignCenter)
         main_layout.addWidget(title_label)
 
+        self.model_status_label = QLabel()
+        self.model_status_label.setAlignment(Qt.AlignCenter)
+        main_layout.addWidget(self.model_status_label)
+
         self.image_label = QLabel()
         self.image_label.setFixedSize(600, 400)
         self.image_label.setAlignment(Qt.AlignCenter)
         self.image_label.setStyleSheet("border: 2px solid #ccc;")
         main_layout.addWidget(self.image_label, alignment=Qt.AlignCenter)
 
+        # Stepping through an opened folder; neighbours are prepared in the background
+        nav_layout = QHBoxLayout()
+        self.prev_btn = QPushButton("◀ Previous")
+        self.prev_btn.clicked.connect(lambda: self.step_image(-1))
+        nav_layout.addWidget(self.prev_btn)
+        self.image_nav_label = QLabel()
+        self.image_nav_label.setAlignment(Qt.AlignCenter)
+        nav_layout.addWidget(self.image_nav_label)
+        self.next_btn = QPushButton("Next ▶")
+        self.next_btn.clicked.connect(lambda: self.step_image(1))
+        nav_layout.addWidget(self.next_btn)
+        main_layout.addLayout(nav_layout)
+        self.nav_widgets = [self.prev_btn, self.image_nav_label, self.next_btn]
+        for widget in self.nav_widgets:
+            widget.setVisible(False)
+        QShortcut(QKeySequence("PgUp"), self, lambda: self.step_image(-1))
+        QShortcut(QKeySequence("PgDown"), self, lambda: self.step_image(1))
+
+        # Timings drawn over the preview; F12 toggles it and turns collection on
+        self.perf_overlay = QLabel(self.image_label)
+        self.perf_overlay.setStyleSheet(
+            "background-color: rgba(0, 0, 0, 160); color: #7CFC00; font-family: monospace; font-size: 10px; "
+            "padding: 4px;"
+        )
+        self.perf_overlay.move(4, 4)
+        self.perf_overlay.setVisible(False)
+        self.perf_timer = QTimer(self)
+        self.perf_timer.setInterval(500)
+        self.perf_timer.timeout.connect(self.update_perf_overlay)
+        QShortcut(QKeySequence("F12"), self, self.toggle_perf_overlay)
+        if PERF_OVERLAY:
+            self.toggle_perf_overlay()
+
         main_layout.addItem(QSpacerItem(20, 40, QSizePolicy.Minimum, QSizePolicy.Expanding))
 
         button_layout = QHBoxLayout()
@@ -142,6 +263,11 @@ class AnalyzingPage(QWidget):
         self.upload_img_btn.setStyleSheet(self.button_style())
         button_layout.addWidget(self.upload_img_btn)
 
+        self.open_folder_btn = QPushButton("📂 Open Folder")
+        self.open_folder_btn.clicked.connect(self.open_folder)
+        self.open_folder_btn.setStyleSheet(self.button_style())
+        button_layout.addWidget(self.open_folder_btn)
+
         self.remove_img_btn = QPushButton("❌ Remove Image")
         self.remove_img_btn.clicked.connect(self.remove_image)
         self.remove_img_btn.setStyleSheet(self.button_style())
@@ -153,6 +279,11 @@ class AnalyzingPage(QWidget):
         self.upload_video_btn.setStyleSheet(self.button_style())
         button_layout.addWidget(self.upload_video_btn)
 
+        self.fast_video_btn = QPushButton("⚡ Fast Analyze Video")
+        self.fast_video_btn.clicked.connect(self.fast_analyze_video)
+        self.fast_video_btn.setStyleSheet(self.button_style())
+        button_layout.addWidget(self.fast_video_btn)
+
         self.open_camera_btn = QPushButton("📸 Open Camera")
         self.open_camera_btn.clicked.connect(self.open_camera)
         self.open_camera_btn.setStyleSheet(self.button_style())
@@ -194,12 +325,61 @@ class AnalyzingPage(QWidget):
         self.rewind_btn.setVisible(False)
         button_layout.addWidget(self.rewind_btn)
 
+        self.forward_btn = QPushButton("⏩ Forward 5s")
+        self.forward_btn.clicked.connect(self.forward_video)
+        self.forward_btn.setStyleSheet(self.button_style())
+        self.forward_btn.setVisible(False)
+        button_layout.addWidget(self.forward_btn)
+
         self.stop_video_btn = QPushButton("⏹ Stop Video")
         self.stop_video_btn.clicked.connect(self.stop_video)
         self.stop_video_btn.setStyleSheet(self.button_style())
         self.stop_video_btn.setVisible(False)
         button_layout.addWidget(self.stop_video_btn)
 
+        fast_layout = QHBoxLayout()
+        fast_layout.addWidget(QLabel("Playback:"))
+        self.playback_combo = QComboBox()
+        self.playback_combo.addItem("Real-time (skip frames)", "realtime")
+        self.playback_combo.addItem("Every frame", "exhaustive")
+        self.playback_combo.setCurrentIndex(max(self.playback_combo.findData(PLAYBACK_MODE), 0))
+        fast_layout.addWidget(self.playback_combo)
+        fast_layout.addWidget(QLabel("Fast analysis sampling (frames/s):"))
+        self.sample_fps_spin = QSpinBox()
+        self.sample_fps_spin.setRange(0, 60)
+        self.sample_fps_spin.setValue(5)
+        self.sample_fps_spin.setSpecialValueText("Every frame")
+        fast_layout.addWidget(self.sample_fps_spin)
+        self.analysis_progress = QProgressBar()
+        self.analysis_progress.setVisible(False)
+        fast_layout.addWidget(self.analysis_progress)
+        self.analysis_eta_label = QLabel()
+        fast_layout.addWidget(self.analysis_eta_label)
+        main_layout.addLayout(fast_layout)
+
+        # High-resolution sources lose small lesions when the whole frame is scaled
+        # down to the model size; these run the detector on tiles of the dentition
+        tiling_layout = QHBoxLayout()
+        tiling_layout.addWidget(QLabel("ROI tiled inference for:"))
+        self.tiled_checks = {}
+        for source, label in [("image", "Images"), ("video", "Videos"), ("camera", "Camera")]:
+            check = QCheckBox(label)
+            check.setChecked(source in TILED_MODES)
+            tiling_layout.addWidget(check)
+            self.tiled_checks[source] = check
+        tiling_layout.addStretch()
+        main_layout.addLayout(tiling_layout)
+
+        # Several chairs on one machine can share one model through inferenceserver.py
+        server_layout = QHBoxLayout()
+        self.server_check = QCheckBox("Use inference server:")
+        self.server_check.setChecked(bool(INFERENCE_SERVER))
+        self.server_check.toggled.connect(self.toggle_inference_server)
+        server_layout.addWidget(self.server_check)
+        self.server_edit = QLineEdit(INFERENCE_SERVER or DEFAULT_SERVER_URL)
+        server_layout.addWidget(self.server_edit)
+        main_layout.addLayout(server_layout)
+
         self.analyze_btn = QPushButton("📊 Analyze")
         self.analyze_btn.clicked.connect(self.go_to_result_page)
         self.analyze_btn.setVisible(False)
@@ -212,6 +392,28 @@ class AnalyzingPage(QWidget):
         back_btn.setStyleSheet(self.button_style())
         main_layout.addWidget(back_btn)    
 
+        # ModelManager reports from its loader thread; the signal hops to the GUI thread
+        self.model_state_changed.connect(self.show_model_state)
+        model.add_listener(self.model_state_changed.emit)
+        self.show_model_state(model.state)
+
+    def show_model_state(self, state):
+        messages = {
+            "idle": "⏳ Model not loaded yet",
+            "loading": "⏳ Loading model...",
+            "warming": "⏳ Warming up model...",
+            "ready": "✅ Model ready",
+            "error": f"⚠️ Model failed to load: {model.error}",
+        }
+        if state == "ready" and model.backend.name == "remote":
+            messages["ready"] = f"✅ Model ready (inference server {model.path})"
+        self.model_status_label.setText(messages.get(state, state))
+        if state == "ready" and (self.inference_cache is None or self.inference_cache.weights_hash != model.weights_hash):
+            self.inference_cache = InferenceCache(model.weights_hash)
+        self.server_edit.setEnabled(state in ("ready", "error") and not self.server_check.isChecked())
+        for btn in [self.upload_img_btn, self.open_folder_btn, self.upload_video_btn, self.fast_video_btn, self.open_camera_btn]:
+            btn.setEnabled(state == "ready")
+
     def button_style(self):
         return """
             QPushButton {
@@ -229,29 +431,122 @@ class AnalyzingPage(QWidget):
             }
         """
 
+    def toggle_perf_overlay(self):
+        if not self.perf_overlay.isHidden():
+            self.perf_timer.stop()
+            self.perf_overlay.setVisible(False)
+            # Collection started by F12 ends with the overlay; CARIES_PERF=1 keeps it on
+            if not PERF_ENABLED:
+                perf.stop()
+            return
+        perf.enable()
+        self.update_perf_overlay()
+        self.perf_overlay.setVisible(True)
+        self.perf_timer.start()
+
+    def update_perf_overlay(self):
+        self.perf_overlay.setText(format_overlay(perf.snapshot()))
+        self.perf_overlay.adjustSize()
+
+    def toggle_inference_server(self, checked):
+        # Nothing may be predicting while the backend is swapped
+        self.clear_video()
+        self.stop_image_loader()
+        path, backend = (self.server_edit.text().strip(), "remote") if checked else (MODEL_PATH, BACKEND)
+        if not model.switch(path, backend):
+            self.server_check.blockSignals(True)
+            self.server_check.setChecked(not checked)
+            self.server_check.blockSignals(False)
+            QMessageBox.warning(self, "Model Busy", "The model is still loading, try again in a moment.")
+
+    def detector_for(self, source):
+        # A fresh TiledDetector per image, video or camera session, since it keeps the ROI
+        return TiledDetector(model) if self.tiled_checks[source].isChecked() else model
+
     def upload_image(self):
         self.clear_video()
-        file_path, _ = QFileDialog.getOpenFileName(self, "Select Image", "", "Image Files (*.png *.jpg *.jpeg)")
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Image", "", IMAGE_FILTER)
         if file_path:
-            results_list = model(file_path)
-            img = results_list[0].plot()
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            height, width, channel = img_rgb.shape
-            bytes_per_line = 3 * width
-            q_img = QImage(img_rgb.data, width, height, bytes_per_line, QImage.Format_RGB888)
-            pixmap = QPixmap.fromImage(q_img)
-            self.image_label.setPixmap(pixmap)
-            self.image_label.setScaledContents(True)
-            self.detection_results = [results_list[0]]
-            self.mode = "image"
-            self.analyze_btn.setVisible(True)
-            self.remove_img_btn.setVisible(True)
-            self.upload_video_btn.setVisible(False)
+            self.open_images([file_path])
+
+    def open_folder(self):
+        self.clear_video()
+        folder = QFileDialog.getExistingDirectory(self, "Select Patient Folder")
+        if folder:
+            paths = list_images(folder)
+            if not paths:
+                QMessageBox.warning(self, "No Images", "The selected folder contains no images.")
+                return
+            self.open_images(paths)
+
+    def open_images(self, paths):
+        # Decoding, detection and drawing run on the loader's thread; the result
+        # arrives in show_loaded_image
+        self.stop_image_loader()
+        tiled = self.tiled_checks["image"].isChecked()
+        self.image_loader = ImageLoader(paths, (lambda: TiledDetector(model)) if tiled else (lambda: model),
+                                        model.names, self.display_size(), self.inference_cache)
+        self.image_loader.loaded.connect(self.show_loaded_image)
+        self.image_loader.failed.connect(self.image_failed)
+        self.notify_loaded = True
+        self.image_index = 0
+        for widget in self.nav_widgets:
+            widget.setVisible(len(paths) > 1)
+        self.show_image_at(0)
+
+    def show_image_at(self, index):
+        self.image_index = index
+        self.prev_btn.setEnabled(index > 0)
+        self.next_btn.setEnabled(index < len(self.image_loader.paths) - 1)
+        self.image_load_started = time.perf_counter()
+        if not self.image_loader.show(index):
+            self.analyze_btn.setVisible(False)
+            self.image_nav_label.setText(f"{self.image_nav_text(index)} (loading...)")
+
+    def step_image(self, step):
+        if self.image_loader and 0 <= self.image_index + step < len(self.image_loader.paths):
+            self.show_image_at(self.image_index + step)
+
+    def image_nav_text(self, index):
+        paths = self.image_loader.paths
+        return f"{index + 1} / {len(paths)}: {os.path.basename(paths[index])}"
+
+    def show_loaded_image(self, index, result):
+        if self.sender() is not self.image_loader or index != self.image_index:
+            return
+        self.image_label.setPixmap(QPixmap.fromImage(result.q_img))
+        self.detection_store = result.store
+        if perf.enabled:
+            for stage, ms in result.timings.items():
+                perf.record(stage, ms)
+            perf.record("end_to_end", (time.perf_counter() - self.image_load_started) * 1000)
+        self.mode = "image"
+        self.analyze_btn.setVisible(True)
+        self.remove_img_btn.setVisible(True)
+        self.upload_video_btn.setVisible(False)
+        self.image_nav_label.setText(self.image_nav_text(index))
+        if self.notify_loaded:
+            self.notify_loaded = False
             QMessageBox.information(self, "Image Uploaded", "Image uploaded and processed. Click 'Analyze' to continue.")
 
+    def image_failed(self, index, message):
+        if self.sender() is not self.image_loader or index != self.image_index:
+            return
+        self.notify_loaded = False
+        self.image_nav_label.setText(self.image_nav_text(index))
+        QMessageBox.warning(self, "Error", f"Failed to process image: {message}")
+
+    def stop_image_loader(self):
+        if self.image_loader:
+            self.image_loader.stop()
+            self.image_loader = None
+        for widget in self.nav_widgets:
+            widget.setVisible(False)
+
     def remove_image(self):
+        self.stop_image_loader()
         self.image_label.clear()
-        self.detection_results = []
+        self.detection_store = DetectionStore(model.names)
         self.mode = None
         self.analyze_btn.setVisible(False)
         self.remove_img_btn.setVisible(False)
@@ -259,98 +554,213 @@ class AnalyzingPage(QWidget):
 
     def upload_video(self):
         self.remove_image()
-        file_path, _ = QFileDialog.getOpenFileName(self, "Select Video", "", "Video Files (*.mp4 *.avi *.mov)")
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Video", "", VIDEO_FILTER)
         if file_path:
             self.cap = cv2.VideoCapture(file_path)
             if not self.cap.isOpened():
                 QMessageBox.warning(self, "Error", "Failed to open video.")
                 return
-            self.detection_results = []
+            self.detection_store = DetectionStore(model.names)
             self.mode = "video"
             self.analyze_btn.setVisible(False)
             self.upload_img_btn.setVisible(False)
+            self.open_folder_btn.setVisible(False)
             self.pause_btn.setVisible(True)
             self.continue_btn.setVisible(True)
             self.rewind_btn.setVisible(True)
+            self.forward_btn.setVisible(True)
             self.stop_video_btn.setVisible(True)
-            self.timer.start(30)
+            self.start_pipeline(live=False)
             QMessageBox.information(self, "Video Processing", "Video is playing. Analyze button will appear when video is finished.")
 
-    def update_frame(self):
-        if self.cap and self.cap.isOpened():
-            if not self.paused:
-                ret, frame = self.cap.read()
-                if ret:
-                    results_list = model(frame)
-                    self.detection_results.append(results_list[0])
-                    img = results_list[0].plot()
-                    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                    height, width, channel = img_rgb.shape
-                    bytes_per_line = 3 * width
-                    q_img = QImage(img_rgb.data, width, height, bytes_per_line, QImage.Format_RGB888)
-                    pixmap = QPixmap.fromImage(q_img)
-                    self.image_label.setPixmap(pixmap)
-                    self.image_label.setScaledContents(True)
-                    if self.recording and self.video_writer:
-                        self.video_writer.write(img)
-                else:
-                    self.cap.release()
-                    self.cap = None
-                    self.timer.stop()
-                    self.analyze_btn.setVisible(True)
-                    QMessageBox.information(self, "Video Finished", "Video finished. Click 'Analyze' to view results.")
+    def display_size(self):
+        # Frames are rendered at exactly the size the label shows them
+        size = self.image_label.contentsRect().size()
+        return size.width(), size.height()
+
+    def fast_analyze_video(self):
+        self.remove_image()
+        self.clear_video()
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Video", "", VIDEO_FILTER)
+        if file_path:
+            self.detection_store = DetectionStore(model.names)
+            self.mode = "video"
+            self.analysis_worker = VideoAnalysisWorker(file_path, self.detector_for("video"), self.detection_store,
+                                                       target_fps=self.sample_fps_spin.value() or None,
+                                                       cache=self.inference_cache)
+            self.analysis_worker.progress.connect(self.show_analysis_progress)
+            self.analysis_worker.finished.connect(self.fast_analysis_finished)
+            self.analysis_worker.failed.connect(self.fast_analysis_failed)
+            self.analysis_progress.setValue(0)
+            self.analysis_progress.setVisible(True)
+            self.analysis_eta_label.setText("")
+            self.analyze_btn.setVisible(False)
+            self.upload_img_btn.setVisible(False)
+            self.open_folder_btn.setVisible(False)
+            self.stop_video_btn.setVisible(True)
+            self.analysis_worker.start()
+
+    def stop_analysis_worker(self):
+        if self.analysis_worker:
+            self.analysis_worker.cancel()
+            self.analysis_worker = None
+        self.analysis_progress.setVisible(False)
+        self.analysis_eta_label.setText("")
+
+    def show_analysis_progress(self, done, total, eta):
+        if self.sender() is not self.analysis_worker:
+            return
+        self.analysis_progress.setMaximum(max(total, 1))
+        self.analysis_progress.setValue(min(done, total))
+        self.analysis_eta_label.setText(f"ETA {int(eta) // 60}:{int(eta) % 60:02d}")
+
+    def fast_analysis_finished(self):
+        if self.sender() is not self.analysis_worker:
+            return
+        self.stop_analysis_worker()
+        self.stop_video_btn.setVisible(False)
+        self.upload_img_btn.setVisible(True)
+        self.open_folder_btn.setVisible(True)
+        self.analyze_btn.setVisible(True)
+        self.go_to_result_page()
+
+    def fast_analysis_failed(self, message):
+        if self.sender() is not self.analysis_worker:
+            return
+        self.stop_analysis_worker()
+        self.stop_video_btn.setVisible(False)
+        self.upload_img_btn.setVisible(True)
+        self.open_folder_btn.setVisible(True)
+        QMessageBox.warning(self, "Error", f"Video analysis failed: {message}")
+
+    def start_pipeline(self, live):
+        self.stop_pipeline()
+        self.paused = False
+        detector = self.detector_for("camera" if live else "video")
+        self.pipeline = FramePipeline(self.cap, detector, live, self.detection_store, self.display_size(),
+                                      self.playback_combo.currentData())
+        self.pipeline.frame_ready.connect(self.update_frame)
+        self.pipeline.finished.connect(self.video_finished)
+        self.pipeline.failed.connect(self.pipeline_failed)
+        perf.set_source("pipeline", self.pipeline.stats)
+        self.pipeline.start()
+
+    def stop_pipeline(self):
+        if self.pipeline:
+            perf.set_source("pipeline", None)
+            # An annotate thread outliving the join timeout must not reach a released recorder
+            self.pipeline.set_frame_sink(None)
+            self.pipeline.stop()
+            self.pipeline = None
+
+    def update_frame(self, q_img, frame_index, detections):
+        # Frames still queued from a pipeline that has since been stopped are ignored
+        if self.sender() is not self.pipeline:
+            return
+        started = time.perf_counter()
+        pixmap = QPixmap.fromImage(q_img)
+        self.image_label.setPixmap(pixmap)
+        # The pixmap holds its own copy; the pipeline may reuse the buffer
+        self.pipeline.frame_shown()
+        if perf.enabled:
+            perf.record("display", (time.perf_counter() - started) * 1000)
+            perf.frame_shown(frame_index)
+
+    def video_finished(self):
+        if self.sender() is not self.pipeline:
+            return
+        self.stop_pipeline()
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+        self.analyze_btn.setVisible(True)
+        QMessageBox.information(
+            self, "Video Finished",
+            f"Video finished: {self.detection_store.frame_count} frames analyzed, "
+            f"{self.detection_store.skipped_frames} skipped. Click 'Analyze' to view results."
+        )
+
+    def pipeline_failed(self, message):
+        if self.sender() is not self.pipeline:
+            return
+        self.clear_video()
+        for btn in [self.stop_camera_btn, self.record_btn, self.stop_record_btn]:
+            btn.setVisible(False)
+        self.upload_video_btn.setVisible(True)
+        self.analyze_btn.setVisible(self.detection_store.frame_count > 0)
+        QMessageBox.warning(self, "Error", f"Detection failed, playback stopped: {message}")
 
     def pause_video(self):
         self.paused = True
+        if self.pipeline:
+            self.pipeline.pause()
 
     def continue_video(self):
         self.paused = False
+        if self.pipeline:
+            self.pipeline.resume()
 
     def rewind_video(self):
-        if self.cap:
-            current_frame = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
-            fps = self.cap.get(cv2.CAP_PROP_FPS)
-            rewind_frames = int(fps * 5)
-            target_frame = max(current_frame - rewind_frames, 0)
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+        if self.pipeline:
+            self.pipeline.seek(-5)
+
+    def forward_video(self):
+        if self.pipeline:
+            self.pipeline.seek(5)
 
     def stop_video(self):
+        self.stop_pipeline()
+        self.stop_analysis_worker()
         if self.cap:
             self.cap.release()
             self.cap = None
-        self.timer.stop()
         self.image_label.clear()
-        self.detection_results = []
+        self.detection_store = DetectionStore(model.names)
         self.mode = None
         self.analyze_btn.setVisible(False)
-        for btn in [self.pause_btn, self.continue_btn, self.rewind_btn, self.stop_video_btn]:
+        for btn in [self.pause_btn, self.continue_btn, self.rewind_btn, self.forward_btn, self.stop_video_btn]:
             btn.setVisible(False)
         self.upload_img_btn.setVisible(True)
+        self.open_folder_btn.setVisible(True)
         QMessageBox.information(self, "Video Stopped", "Video playback stopped.")
 
     def start_recording(self):
         if self.cap and self.patient_data.get("Name"):
             folder_name = f"{self.patient_data['Name']}_result"
             os.makedirs(folder_name, exist_ok=True)
-            recording_path = os.path.join(folder_name, "camera_record.mp4")
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
             fps = self.cap.get(cv2.CAP_PROP_FPS) or 20.0
             width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.video_writer = cv2.VideoWriter(recording_path, fourcc, fps, (width, height))
+            self.recorder = Recorder(folder_name, fps, (width, height), model.names)
+            perf.set_source("recorder", self.recorder.totals)
+            if self.pipeline:
+                self.pipeline.set_frame_sink(self.recorder.write)
             self.recording = True
             self.record_btn.setVisible(False)
             self.stop_record_btn.setVisible(True)
             QMessageBox.information(self, "Recording", "Recording started.")
 
-    def stop_recording(self):
-        if self.video_writer:
-            self.video_writer.release()
-            self.video_writer = None
+    def release_recorder(self):
+        # Returns a summary of what was written, or None if nothing was recording
+        if self.pipeline:
+            self.pipeline.set_frame_sink(None)
         self.recording = False
+        if not self.recorder:
+            return None
+        perf.set_source("recorder", None)
+        self.recorder.release()
+        summary = "\n".join(
+            f"{path}: {stats['written']} frames written, {stats['dropped']} dropped"
+            for path, stats in zip(self.recorder.paths, self.recorder.stats().values())
+        )
+        self.recorder = None
+        return summary
+
+    def stop_recording(self):
+        summary = self.release_recorder()
         self.record_btn.setVisible(True)
         self.stop_record_btn.setVisible(False)
-        QMessageBox.information(self, "Recording Stopped", f"Recording saved to {self.patient_data['Name']}_result/camera_record.mp4")
+        QMessageBox.information(self, "Recording Stopped", f"Recording saved to\n{summary}")
 
 
     def open_camera(self):
@@ -360,57 +770,51 @@ class AnalyzingPage(QWidget):
         if not self.cap.isOpened():
             QMessageBox.warning(self, "Error", "Failed to open camera.")
             return
-        self.detection_results = []
+        self.detection_store = DetectionStore(model.names)
         self.mode = "camera"
         self.upload_img_btn.setVisible(False)
+        self.open_folder_btn.setVisible(False)
         self.upload_video_btn.setVisible(False)
         self.stop_camera_btn.setVisible(True)
         self.record_btn.setVisible(True)
-        self.timer.start(30)
+        self.start_pipeline(live=True)
         QMessageBox.information(self, "Camera Processing", "Live camera started. Click 'Stop Camera' to finish.")
 
 
 
     def stop_camera(self):
+        self.stop_pipeline()
         if self.cap:
             self.cap.release()
             self.cap = None
-        self.timer.stop()
-        if self.recording and self.video_writer:
-            self.video_writer.release()
-            self.video_writer = None
-            self.recording = False
-
-            # Save the recording into patient's folder
-            if self.patient_data.get("Name"):
-                folder_name = f"{self.patient_data['Name']}_result"
-                os.makedirs(folder_name, exist_ok=True)
-                src_file = "camera_record.mp4"
-                dst_file = os.path.join(folder_name, "camera_record.mp4")
-                if os.path.exists(src_file):
-                    os.replace(src_file, dst_file)
-                QMessageBox.information(self, "Recording Saved", f"Recording saved as {dst_file}")
+        summary = self.release_recorder()
+        if summary:
+            QMessageBox.information(self, "Recording Saved", f"Recording saved as\n{summary}")
 
         self.analyze_btn.setVisible(True)
         self.stop_camera_btn.setVisible(False)
         self.record_btn.setVisible(False)
         self.stop_record_btn.setVisible(False)
         self.upload_img_btn.setVisible(True)
+        self.open_folder_btn.setVisible(True)
         self.upload_video_btn.setVisible(True)
         QMessageBox.information(self, "Camera Stopped", "Click 'Analyze' to view results.")
 
     def clear_video(self):
+        self.stop_pipeline()
+        self.release_recorder()
+        self.stop_analysis_worker()
         if self.cap:
             self.cap.release()
             self.cap = None
-            self.timer.stop()
-            for btn in [self.pause_btn, self.continue_btn, self.rewind_btn, self.stop_video_btn]:
+            for btn in [self.pause_btn, self.continue_btn, self.rewind_btn, self.forward_btn, self.stop_video_btn]:
                 btn.setVisible(False)
             self.upload_img_btn.setVisible(True)
+            self.open_folder_btn.setVisible(True)
 
     def go_to_result_page(self):
-        if self.detection_results:
-            result_page = ResultPage(self.stacked_widget, self.detection_results, self.mode, self.patient_data)
+        if self.detection_store.frame_count:
+            result_page = ResultPage(self.stacked_widget, self.detection_store, self.mode, self.patient_data, self.visit_id)
             if self.stacked_widget.count() > 2:
                 self.stacked_widget.removeWidget(self.stacked_widget.widget(2))
             self.stacked_widget.addWidget(result_page)
@@ -419,9 +823,17 @@ class AnalyzingPage(QWidget):
             QMessageBox.warning(self, "No Data", "Please upload, complete video, or stop camera before analyzing.")
 
 class ResultPage(QWidget):
-    def __init__(self, stacked_widget, detection_results, mode, patient_data):
+    # Futures from report_executor, delivered on the GUI thread
+    chart_done = Signal(object)
+    report_done = Signal(object)
+
+    def __init__(self, stacked_widget, detection_store, mode, patient_data, visit_id=None):
         super().__init__()
         self.stacked_widget = stacked_widget
+        self.detection_store = detection_store
+        self.mode = mode
+        self.visit_id = visit_id
+        self.patient_data = patient_data
 
         layout = QVBoxLayout()
         layout.setAlignment(Qt.AlignCenter)
@@ -432,25 +844,28 @@ class ResultPage(QWidget):
         title_label.setAlignment(Qt.AlignCenter)
         layout.addWidget(title_label)
 
-        fig = Figure(figsize=(4, 4))
-        canvas = FigureCanvas(fig)
-        ax = fig.add_subplot(111)
+        self.chart_label = QLabel("Drawing chart...")
+        self.chart_label.setAlignment(Qt.AlignCenter)
+        self.chart_label.setMinimumSize(400, 400)
+        layout.addWidget(self.chart_label)
 
-        classes = ["Healthy", "Initial", "Moderate", "Extensive"]
-        counts = {cls: 0 for cls in classes}
-        for result in detection_results:
-            for r in result.boxes.cls.tolist():
-                label = model.names[int(r)]
-                if label in counts:
-                    counts[label] += 1
+        classes = CLASSES
+        if mode == "image":
+            lesions = []
+            counts = detection_store.class_counts()
+        else:
+            # A lesion on screen for seconds is one tracked lesion, not one box per frame
+            lesions = detection_store.lesions()
+            counts = {cls: 0 for cls in classes}
+            for lesion in lesions:
+                if lesion["class"] in counts:
+                    counts[lesion["class"]] += 1
+        self.counts = counts
 
-        total = sum(counts.values()) or 1
-        sizes = [counts[cls] for cls in classes]
-        labels = [f"{cls} ({(counts[cls]/total)*100:.1f}%)" for cls in classes]
+        self.chart_done.connect(self.show_chart)
+        report_executor.submit(render_chart, counts).add_done_callback(self.chart_done.emit)
 
-        ax.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=140)
-        ax.set_title("Caries Class Distribution")
-        layout.addWidget(canvas)
+        total = sum(counts.values()) or 1
 
         table = QTableWidget()
         table.setRowCount(len(classes))
@@ -464,41 +879,89 @@ class ResultPage(QWidget):
                 table.setItem(i, 1, QTableWidgetItem(str(quantity)))
                 table.setItem(i, 2, QTableWidgetItem(f"{percentage:.2f}"))
         else:
-            table.setColumnCount(2)
-            table.setHorizontalHeaderLabels(["Class", "Percentage (%)"])
+            table.setColumnCount(4)
+            table.setHorizontalHeaderLabels(["Class", "Lesions", "Mean Confidence", "Percentage (%)"])
             for i, cls in enumerate(classes):
+                confidences = [lesion["confidence"] for lesion in lesions if lesion["class"] == cls]
                 percentage = (counts[cls] / total) * 100
                 table.setItem(i, 0, QTableWidgetItem(cls))
-                table.setItem(i, 1, QTableWidgetItem(f"{percentage:.2f}"))
+                table.setItem(i, 1, QTableWidgetItem(str(counts[cls])))
+                table.setItem(i, 2, QTableWidgetItem(f"{sum(confidences) / len(confidences):.2f}" if confidences else "-"))
+                table.setItem(i, 3, QTableWidgetItem(f"{percentage:.2f}"))
 
         detail_layout = QVBoxLayout()
         for key, value in patient_data.items():
             detail_layout.addWidget(QLabel(f"{key}: {value}"))
+        self.details = []
+        if mode != "image":
+            analyzed = detection_store.frame_count
+            skipped = detection_store.skipped_frames
+            coverage = analyzed / (analyzed + skipped) * 100 if analyzed + skipped else 0.0
+            self.details = [
+                f"Source: {mode}",
+                f"Frames analyzed: {analyzed} ({detection_store.detected_frames} by the detector, the rest tracked)",
+                f"Frames skipped: {skipped} ({coverage:.1f}% coverage)",
+            ]
+        for line in self.details:
+            detail_layout.addWidget(QLabel(line))
 
         h_layout = QHBoxLayout()
         h_layout.addWidget(table)
         h_layout.addLayout(detail_layout)
         layout.addLayout(h_layout)
 
+        if lesions:
+            lesion_table = QTableWidget(len(lesions), 5)
+            lesion_table.setHorizontalHeaderLabels(["Lesion", "Class", "Confidence", "Detections", "Frames"])
+            lesion_table.setMaximumHeight(150)
+            for i, lesion in enumerate(lesions):
+                lesion_table.setItem(i, 0, QTableWidgetItem(f"#{lesion['track']}"))
+                lesion_table.setItem(i, 1, QTableWidgetItem(lesion["class"]))
+                lesion_table.setItem(i, 2, QTableWidgetItem(f"{lesion['confidence']:.2f}"))
+                lesion_table.setItem(i, 3, QTableWidgetItem(str(lesion["hits"])))
+                lesion_table.setItem(i, 4, QTableWidgetItem(f"{lesion['first_frame']}-{lesion['last_frame']}"))
+            layout.addWidget(lesion_table)
+
         # Save Result Button
-        save_btn = QPushButton("💾 Save Analysis Result")
-        save_btn.setStyleSheet(self.button_style())
-        save_btn.clicked.connect(lambda: self.save_analysis(patient_data["Name"], fig))
-        layout.addWidget(save_btn)
+        self.save_btn = QPushButton("💾 Save Analysis Result")
+        self.save_btn.setStyleSheet(self.button_style())
+        self.save_btn.clicked.connect(lambda: self.save_analysis(patient_data["Name"]))
+        layout.addWidget(self.save_btn)
+        self.report_done.connect(self.report_finished)
 
         back_btn = QPushButton("⬅️ Back to Analyzing")
         back_btn.setStyleSheet(self.button_style())
         back_btn.clicked.connect(lambda: self.stacked_widget.setCurrentIndex(1))
         layout.addWidget(back_btn)
 
-    def save_analysis(self, patient_name, figure):
+    def show_chart(self, future):
+        if future.exception() is not None:
+            self.chart_label.setText(f"⚠️ Chart failed: {future.exception()}")
+            return
+        pixmap = QPixmap()
+        pixmap.loadFromData(future.result())
+        self.chart_label.setPixmap(pixmap)
+
+    def save_analysis(self, patient_name):
         folder_name = f"{patient_name}_result"
         os.makedirs(folder_name, exist_ok=True)
-        # Save the entire ResultPage layout
-        pixmap = self.grab()
-        file_path = os.path.join(folder_name, "analysis_result_fullpage.png")
-        pixmap.save(file_path)
-        QMessageBox.information(self, "Saved", f"Full analysis page saved as {file_path}")
+        self.detection_store.export_csv(os.path.join(folder_name, "detections.csv"))
+        if self.visit_id is not None:
+            patient_store.save_detection_summary(
+                self.visit_id, self.mode, self.counts, self.detection_store.frame_count
+            )
+        paths = [os.path.join(folder_name, f"analysis_report.{fmt}") for fmt in REPORT_FORMATS]
+        self.save_btn.setEnabled(False)
+        future = report_executor.submit(render_report, paths, self.patient_data, self.counts, self.mode, self.details)
+        future.add_done_callback(self.report_done.emit)
+
+    def report_finished(self, future):
+        self.save_btn.setEnabled(True)
+        if future.exception() is not None:
+            QMessageBox.warning(self, "Save Failed", f"Could not write the report: {future.exception()}")
+            return
+        QMessageBox.information(self, "Saved", "Analysis report saved as " + " and ".join(future.result()))
+
 
     def button_style(self):
         return """
@@ -525,9 +988,20 @@ class StackedWidget(QStackedWidget):
         self.addWidget(self.home_page)
         self.addWidget(self.analyzing_page)
 
+def window_shown():
+    startup_timer.mark("first_window")
+    model.start()
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     stacked_widget = StackedWidget()
     stacked_widget.setFixedSize(1000, 800)
     stacked_widget.show()
+    # Runs once the event loop has painted the window for the first time
+    QTimer.singleShot(0, window_shown)
+    app.aboutToQuit.connect(startup_timer.write)
+    app.aboutToQuit.connect(stacked_widget.analyzing_page.clear_video)
+    app.aboutToQuit.connect(stacked_widget.analyzing_page.stop_image_loader)
+    app.aboutToQuit.connect(perf.stop)
+    app.aboutToQuit.connect(report_executor.shutdown)
     sys.exit(app.exec())
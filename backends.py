@@ -0,0 +1,377 @@
+import ast
+import hashlib
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+from detectionstore import CLASSES, Detections, box_iou, detections_from_result, empty_detections
+
+# "auto" picks the backend from the model path: .pt -> pytorch, .onnx -> onnxruntime,
+# an OpenVINO export directory or .xml -> openvino
+BACKEND = os.environ.get("CARIES_BACKEND", "auto")
+IMGSZ = 640
+CONF = 0.25
+IOU = 0.7
+MAX_DET = 300
+# Offset that separates classes for class-aware NMS, as in ultralytics
+MAX_WH = 7680
+# Boxes per image and simulated cost per call of the stub backend
+STUB_BOXES = int(os.environ.get("CARIES_STUB_BOXES", 8))
+STUB_DELAY_MS = float(os.environ.get("CARIES_STUB_DELAY_MS", 0))
+# Shared local inference server (inferenceserver.py): http://host:port or
+# unix:///path/to.sock. When set, the app starts in client mode.
+INFERENCE_SERVER = os.environ.get("CARIES_INFERENCE_SERVER", "")
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_SERVER_URL = f"http://127.0.0.1:{DEFAULT_SERVER_PORT}"
+REMOTE_TIMEOUT = float(os.environ.get("CARIES_REMOTE_TIMEOUT", 30))
+
+
+class InferenceBackend(ABC):
+    name = None
+
+    def __init__(self, path, threads=None):
+        self.path = path
+        self.threads = threads
+        self.names = {}
+
+    @abstractmethod
+    def load(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def predict(self, images, **kwargs):
+        # images: list of BGR arrays; returns one Detections per image in source pixels
+        raise NotImplementedError
+
+    def weight_files(self):
+        return [self.path]
+
+    def weights_hash(self):
+        digest = hashlib.sha256()
+        for path in self.weight_files():
+            with open(path, "rb") as f:
+                digest.update(hashlib.file_digest(f, "sha256").digest())
+        return digest.hexdigest()
+
+
+class PyTorchBackend(InferenceBackend):
+    name = "pytorch"
+
+    def load(self):
+        from ultralytics import YOLO
+
+        if self.threads:
+            import torch
+
+            torch.set_num_threads(self.threads)
+        self.model = YOLO(self.path)
+        self.names = self.model.names
+
+    def predict(self, images, **kwargs):
+        return [detections_from_result(result) for result in self.model(images, verbose=False, **kwargs)]
+
+
+def letterbox(img, size):
+    # Same geometry as ultralytics' LetterBox: scale to fit, pad evenly with grey
+    height, width = img.shape[:2]
+    gain = min(size / height, size / width)
+    new_width, new_height = round(width * gain), round(height * gain)
+    pad_x, pad_y = (size - new_width) / 2, (size - new_height) / 2
+    if (new_width, new_height) != (width, height):
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+    left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return img, gain, (left, top)
+
+
+def preprocess(images, size):
+    batch = np.empty((len(images), 3, size, size), np.float32)
+    transforms = []
+    for i, img in enumerate(images):
+        padded, gain, pad = letterbox(img, size)
+        batch[i] = padded[:, :, ::-1].transpose(2, 0, 1)
+        transforms.append((gain, pad, img.shape[:2]))
+    batch /= 255.0
+    return batch, transforms
+
+
+def nms(xyxy, scores, cls, iou=IOU, max_det=MAX_DET):
+    # Greedy NMS with torchvision semantics (suppress IoU > threshold), per class
+    shifted = xyxy + cls[:, None].astype(xyxy.dtype) * MAX_WH
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size and len(keep) < max_det:
+        best = order[0]
+        keep.append(best)
+        order = order[1:]
+        if order.size:
+            order = order[box_iou(shifted[best:best + 1], shifted[order])[0] <= iou]
+    return np.array(keep, np.int64)
+
+
+def postprocess(output, transforms, conf=CONF, iou=IOU, max_det=MAX_DET):
+    # output: (batch, 4 + classes, anchors) raw YOLO head, boxes as cx, cy, w, h
+    detections = []
+    for prediction, (gain, (pad_x, pad_y), (height, width)) in zip(output, transforms):
+        prediction = prediction.T
+        scores = prediction[:, 4:]
+        cls = scores.argmax(1)
+        confidence = scores[np.arange(len(scores)), cls]
+        keep = confidence > conf
+        if not keep.any():
+            detections.append(empty_detections())
+            continue
+        boxes, cls, confidence = prediction[keep, :4], cls[keep], confidence[keep]
+        xyxy = np.column_stack([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2])
+        kept = nms(xyxy, confidence, cls, iou, max_det)
+        xyxy = (xyxy[kept] - [pad_x, pad_y, pad_x, pad_y]) / gain
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, width)
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, height)
+        detections.append(Detections(xyxy.astype(np.float32), confidence[kept].astype(np.float32),
+                                     cls[kept].astype(np.int16)))
+    return detections
+
+
+class ExportedBackend(InferenceBackend):
+    # Shared pre/post-processing for exported graphs, so CPU stations need neither
+    # torch nor ultralytics at inference time
+    imgsz = IMGSZ
+    fixed_batch = None
+
+    @abstractmethod
+    def run(self, batch):
+        raise NotImplementedError
+
+    def predict(self, images, conf=CONF, iou=IOU, max_det=MAX_DET, **kwargs):
+        if not images:
+            return []
+        if self.fixed_batch == 1 and len(images) > 1:
+            return [d for img in images for d in self.predict([img], conf=conf, iou=iou, max_det=max_det)]
+        batch, transforms = preprocess(images, self.imgsz)
+        return postprocess(self.run(batch), transforms, conf, iou, max_det)
+
+
+class OnnxRuntimeBackend(ExportedBackend):
+    name = "onnxruntime"
+
+    def load(self):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self.session = onnxruntime.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, _ = model_input.shape
+        self.fixed_batch = batch if isinstance(batch, int) else None
+        if isinstance(height, int):
+            self.imgsz = height
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata["names"]) if "names" in metadata else {}
+
+    def run(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class OpenVINOBackend(ExportedBackend):
+    name = "openvino"
+
+    def load(self):
+        import openvino
+        import yaml
+
+        xml_path = self.xml_path()
+        core = openvino.Core()
+        model = core.read_model(xml_path)
+        batch, _, height, _ = model.inputs[0].get_partial_shape()
+        self.fixed_batch = batch.get_length() if batch.is_static else None
+        if height.is_static:
+            self.imgsz = height.get_length()
+        config = {"PERFORMANCE_HINT": "LATENCY"}
+        if self.threads:
+            config["INFERENCE_NUM_THREADS"] = self.threads
+        self.compiled = core.compile_model(model, "CPU", config)
+        metadata_path = os.path.join(os.path.dirname(xml_path), "metadata.yaml")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                self.names = yaml.safe_load(f).get("names", {})
+
+    def xml_path(self):
+        if os.path.isdir(self.path):
+            return next(os.path.join(self.path, f) for f in sorted(os.listdir(self.path)) if f.endswith(".xml"))
+        return self.path
+
+    def weight_files(self):
+        xml_path = self.xml_path()
+        return [xml_path, os.path.splitext(xml_path)[0] + ".bin"]
+
+    def run(self, batch):
+        return self.compiled(batch)[0]
+
+
+class StubBackend(InferenceBackend):
+    # Deterministic fake detector for benchmarks and machines without the weights:
+    # the same image always gives the same boxes, seeded from a sample of its pixels
+    name = "stub"
+
+    def __init__(self, path, threads=None, boxes=STUB_BOXES, delay_ms=STUB_DELAY_MS):
+        super().__init__(path, threads)
+        self.boxes = boxes
+        self.delay_ms = delay_ms
+
+    def load(self):
+        self.names = dict(enumerate(CLASSES))
+
+    def weight_files(self):
+        return []
+
+    def weights_hash(self):
+        return hashlib.sha256(f"stub:{self.boxes}".encode()).hexdigest()
+
+    def predict(self, images, conf=CONF, **kwargs):
+        if self.delay_ms:
+            time.sleep(self.delay_ms * len(images) / 1000)
+        detections = []
+        for img in images:
+            height, width = img.shape[:2]
+            rng = np.random.default_rng(int(img[::32, ::32].sum(dtype=np.int64)))
+            corners = rng.uniform(0, 0.8, (self.boxes, 2)) * [width, height]
+            sizes = rng.uniform(0.05, 0.2, (self.boxes, 2)) * [width, height]
+            xyxy = np.hstack([corners, np.minimum(corners + sizes, [width, height])]).astype(np.float32)
+            scores = rng.uniform(0.1, 1, self.boxes).astype(np.float32)
+            cls = rng.integers(0, len(self.names), self.boxes).astype(np.int16)
+            keep = scores > conf
+            detections.append(Detections(xyxy[keep], scores[keep], cls[keep]))
+        return detections
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=REMOTE_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RemoteBackend(InferenceBackend):
+    # Client of inferenceserver.py; path is the server URL. The server owns the
+    # model and batches these frames with other workstations'. Each calling thread
+    # keeps its own keep-alive connection.
+    name = "remote"
+
+    def __init__(self, path, threads=None):
+        super().__init__(path, threads)
+        self.local = threading.local()
+        self.info = {}
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.path.startswith("unix://"):
+                connection = UnixHTTPConnection(self.path[len("unix://"):])
+            else:
+                url = urlsplit(self.path)
+                connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=REMOTE_TIMEOUT)
+            self.local.connection = connection
+        return connection
+
+    def _request(self, method, url, body=None, headers=None):
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, url, body, headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                # The server may have closed an idle keep-alive connection; retry once
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise RuntimeError(f"Inference server returned {response.status}: {data[:200].decode(errors='replace')}")
+            return data
+
+    def health(self):
+        return json.loads(self._request("GET", "/health"))
+
+    def load(self):
+        # The server may still be loading its weights
+        deadline = time.monotonic() + REMOTE_TIMEOUT
+        while True:
+            try:
+                self.info = self.health()
+            except (OSError, http.client.HTTPException, RuntimeError):
+                if time.monotonic() > deadline:
+                    raise
+            else:
+                if self.info["state"] == "ready":
+                    break
+                if self.info["state"] == "error":
+                    raise RuntimeError(f"Inference server failed to load its model: {self.info['error']}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Inference server at {self.path} is still {self.info['state']}")
+            time.sleep(0.5)
+        self.names = {int(k): v for k, v in self.info["names"].items()}
+
+    def weight_files(self):
+        return []
+
+    def weights_hash(self):
+        # Same hash as a local backend on the same weights, so cached results carry over
+        return self.info["weights_hash"]
+
+    def predict(self, images, **kwargs):
+        if not images:
+            return []
+        buffer = io.BytesIO()
+        np.savez(buffer, *images)
+        data = self._request("POST", "/predict", buffer.getvalue(), {
+            "Content-Type": "application/octet-stream",
+            "X-Predict-Args": json.dumps(kwargs),
+        })
+        with np.load(io.BytesIO(data)) as out:
+            return [Detections(out[f"xyxy_{i}"], out[f"conf_{i}"], out[f"cls_{i}"]) for i in range(len(images))]
+
+
+BACKENDS = {
+    "pytorch": PyTorchBackend,
+    "onnxruntime": OnnxRuntimeBackend,
+    "openvino": OpenVINOBackend,
+    "stub": StubBackend,
+    "remote": RemoteBackend,
+}
+
+
+def backend_for_path(path):
+    if path.startswith(("http://", "unix://")):
+        return "remote"
+    if path.endswith(".onnx"):
+        return "onnxruntime"
+    if path.endswith(".xml") or path.rstrip("/\\").endswith("_openvino_model"):
+        return "openvino"
+    return "pytorch"
+
+
+def create_backend(path, name=BACKEND, threads=None):
+    if name == "auto":
+        name = backend_for_path(path)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'")
+    return BACKENDS[name](path, threads)
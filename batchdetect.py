@@ -0,0 +1,200 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+
+from backends import BACKEND
+from detectionstore import CLASSES, DetectionStore
+from mediafiles import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
+from modelmanager import MODEL_PATH, ModelManager
+from videoanalysis import analyze_video
+
+
+_worker = {}
+
+
+def collect_files(inputs):
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return [f for f in files if f.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS)]
+
+
+def load_done(output_path):
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash; that file is simply redone
+                    continue
+                if not record.get("error"):
+                    done.add(record["file"])
+    return done
+
+
+def init_worker(model_path, backend, threads, predict_kwargs):
+    manager = ModelManager(model_path, backend, threads)
+    if manager.load() is None:
+        raise RuntimeError(f"Failed to load {model_path}: {manager.error}")
+    _worker["model"] = manager
+    _worker["predict_kwargs"] = predict_kwargs
+
+
+def make_record(path, kind, store):
+    frames = store.column("frame")
+    detections = [
+        {"frame": int(frame), "xyxy": [round(float(v), 1) for v in box], "conf": round(float(conf), 4), "class": store.label(cls),
+         "track": int(track) if track >= 0 else None}
+        for frame, box, conf, cls, track in zip(frames, store.column("xyxy"), store.column("conf"), store.column("cls"),
+                                                store.column("track"))
+    ]
+    lesions = store.class_counts() if kind == "image" else store.lesion_counts()
+    return {"file": path, "type": kind, "frames": store.frame_count, "counts": store.class_counts(), "lesions": lesions,
+            "detections": detections}
+
+
+def detect_images(paths):
+    model = _worker["model"]
+    records, batch, batch_paths = [], [], []
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            records.append({"file": path, "type": "image", "error": "unreadable image"})
+            continue
+        batch.append(img)
+        batch_paths.append(path)
+    if not batch:
+        return records
+    try:
+        # One model() call for the whole chunk
+        outputs = model.predict(batch, **_worker["predict_kwargs"])
+    except Exception:
+        if len(batch) == 1:
+            raise
+        # Find the image at fault; the rest of the chunk is still recorded
+        return records + [record for path in batch_paths for record in detect_image(path)]
+    for path, detections in zip(batch_paths, outputs):
+        store = DetectionStore(model.names)
+        store.add(0, detections)
+        records.append(make_record(path, "image", store))
+    return records
+
+
+def detect_image(path):
+    try:
+        return detect_images([path])
+    except Exception as e:
+        return [{"file": path, "type": "image", "error": str(e)}]
+
+
+def detect_video(path, batch_size, stride):
+    model = _worker["model"]
+    store = DetectionStore(model.names)
+    try:
+        analyze_video(path, model, store, stride=stride, batch_size=batch_size, **_worker["predict_kwargs"])
+    except Exception as e:
+        return [{"file": path, "type": "video", "error": str(e)}]
+    return [make_record(path, "video", store)]
+
+
+def write_counts_csv(output_path, csv_path):
+    with open(output_path) as f, open(csv_path, "w", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(["file", "type", "frames"] + CLASSES)
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not record.get("error"):
+                writer.writerow([record["file"], record["type"], record["frames"]] + [record["counts"][cls] for cls in CLASSES])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run caries detection over folders of images and videos.")
+    parser.add_argument("inputs", nargs="+", help="Image/video files or folders")
+    parser.add_argument("--output", default="batch_results.jsonl", help="Per-file detections (JSONL, appended to on resume)")
+    parser.add_argument("--csv", default=None, help="Per-file class counts (default: alongside --output)")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--backend", default=BACKEND, help="auto, pytorch, onnxruntime or openvino")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--video-stride", type=int, default=1, help="Analyze every Nth video frame")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--conf", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    files = collect_files(args.inputs)
+    done = load_done(args.output)
+    pending = [f for f in files if f not in done]
+    print(f"{len(files)} files found, {len(files) - len(pending)} already done, {len(pending)} to process")
+
+    images = [f for f in pending if f.lower().endswith(IMAGE_EXTENSIONS)]
+    videos = [f for f in pending if f.lower().endswith(VIDEO_EXTENSIONS)]
+    tasks = [(detect_images, images[i:i + args.batch_size]) for i in range(0, len(images), args.batch_size)]
+    tasks += [(detect_video, path, args.batch_size, args.video_stride) for path in videos]
+    # Task of each future in flight, for error records when a task fails outright
+    task_files = {}
+
+    # Split the cores between workers so each model does not spawn a full thread pool
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    predict_kwargs = {"imgsz": args.imgsz, "conf": args.conf}
+    started = time.perf_counter()
+    analyzed = errors = 0
+    with open(args.output, "a") as out, ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_worker, initargs=(args.model, args.backend, threads, predict_kwargs)
+    ) as pool:
+        queued = iter(tasks)
+        running = set()
+        while True:
+            # Keep a bounded number of tasks in flight rather than submitting everything
+            for task in queued:
+                future = pool.submit(*task)
+                task_files[future] = task
+                running.add(future)
+                if len(running) >= args.workers * 2:
+                    break
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                function, target = task_files.pop(future)[:2]
+                try:
+                    records = future.result()
+                except Exception as e:
+                    # One bad file must not end an overnight run
+                    kind, paths = ("image", target) if function is detect_images else ("video", [target])
+                    records = [{"file": path, "type": kind, "error": str(e)} for path in paths]
+                for record in records:
+                    out.write(json.dumps(record) + "\n")
+                    if record.get("error"):
+                        errors += 1
+                        print(f"{record['file']}: {record['error']}", file=sys.stderr)
+                    else:
+                        analyzed += record["frames"]
+            out.flush()
+            os.fsync(out.fileno())
+
+    elapsed = time.perf_counter() - started
+    csv_path = args.csv or os.path.splitext(args.output)[0] + "_counts.csv"
+    write_counts_csv(args.output, csv_path)
+    rate = analyzed / elapsed if elapsed else 0.0
+    print(f"Analyzed {analyzed} images/frames from {len(pending) - errors} files in {elapsed:.1f}s "
+          f"({rate:.2f} images/s), {errors} errors")
+    print(f"Detections: {args.output}\nClass counts: {csv_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from backends import BACKEND, IMGSZ, create_backend, preprocess
+from detectionstore import CLASSES, DetectionStore
+from patientstore import SQLitePatientStore
+from render import FrameRenderer, draw_detections
+from tracker import LesionTracker
+
+PERCENTILES = (50, 95, 99)
+# A stage regresses when its p50 or p95 grows by more than THRESHOLD and by more
+# than MIN_DELTA_MS, so sub-millisecond stages do not flag on timer noise
+THRESHOLD = 0.10
+MIN_DELTA_MS = 0.05
+DISPLAY_SIZE = (596, 396)
+
+
+def synthetic_frame(index, width, height):
+    # Smooth background with a few bright moving ellipses, so the codec and the
+    # detector see something closer to an intraoral image than white noise
+    rng = np.random.default_rng(index)
+    gradient = np.linspace(40, 120, width, dtype=np.float32)
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = np.stack([gradient, gradient * 0.8, gradient * 1.2], axis=-1).clip(0, 255).astype(np.uint8)
+    for tooth in range(6):
+        x = int((tooth + 0.5) * width / 6 + 8 * np.sin(index / 10 + tooth))
+        y = int(height / 2 + 6 * np.cos(index / 12 + tooth))
+        cv2.ellipse(img, (x, y), (width // 16, height // 5), 0, 0, 360, (215, 225, 235), -1, cv2.LINE_AA)
+    img += rng.integers(0, 8, img.shape, np.uint8)
+    return img
+
+
+def write_media(folder, frames, images, width, height, fps):
+    video_path = os.path.join(folder, "synthetic.mp4")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for index in range(frames):
+        writer.write(synthetic_frame(index, width, height))
+    writer.release()
+    image_paths = []
+    for index in range(images):
+        path = os.path.join(folder, f"synthetic_{index}.jpg")
+        cv2.imwrite(path, synthetic_frame(10000 + index, width, height))
+        image_paths.append(path)
+    return video_path, image_paths
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, stage, fn, *args, **kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.samples.setdefault(stage, []).append((time.perf_counter() - started) * 1000)
+        return result
+
+    def summary(self):
+        stages = {}
+        for stage, timings in self.samples.items():
+            timings = np.array(timings)
+            entry = {"samples": len(timings), "mean_ms": round(float(timings.mean()), 4)}
+            for p in PERCENTILES:
+                entry[f"p{p}_ms"] = round(float(np.percentile(timings, p)), 4)
+            entry["throughput_per_s"] = round(len(timings) / (timings.sum() / 1000), 2) if timings.sum() else None
+            stages[stage] = entry
+        return stages
+
+
+def run(args):
+    backend_name = "stub" if args.model == "stub" else args.backend
+    backend = create_backend(args.model, backend_name, args.threads)
+    backend.load()
+    backend.predict([synthetic_frame(0, args.width, args.height)])
+    names = backend.names or dict(enumerate(CLASSES))
+    renderer = FrameRenderer(*DISPLAY_SIZE, names)
+    timer = StageTimer()
+
+    with tempfile.TemporaryDirectory(prefix="caries-bench-") as folder:
+        video_path, image_paths = write_media(folder, args.frames, args.images, args.width, args.height, args.fps)
+
+        for _ in range(args.repeat):
+            for path in image_paths:
+                timer.time("decode_image", cv2.imread, path)
+
+        store = DetectionStore(names)
+        for repeat in range(args.repeat):
+            tracker = LesionTracker()
+            cap = cv2.VideoCapture(video_path)
+            frame_index = 0
+            while True:
+                ret, frame = timer.time("decode_video", cap.read)
+                if not ret:
+                    break
+                timer.time("preprocess", preprocess, [frame], args.imgsz)
+                detections = timer.time("inference", backend.predict, [frame])[0]
+                detections = timer.time("tracking", tracker.update, frame_index, frame, detections)
+                if repeat == 0:
+                    store.add(frame_index, detections)
+                timer.time("annotate", draw_detections, frame.copy(), detections, names)
+                timer.time("qimage", renderer.render, frame, detections)
+                frame_index += 1
+            cap.release()
+
+        # What ResultPage computes before drawing: per-class box counts for a photo,
+        # tracked lesions per class for a video session
+        for _ in range(args.aggregate_runs):
+            timer.time("aggregate_image", store.class_counts)
+            counts = timer.time("aggregate_video", store.lesion_counts)
+        total = sum(counts.values()) or 1
+        shares = {cls: counts[cls] / total for cls in CLASSES}
+
+        # save_patient_data plus the detection summary written by "Save Analysis Result"
+        patient_store = SQLitePatientStore(os.path.join(folder, "bench.db"))
+        patient = {"Date": "2024-01-01", "Name": "Benchmark", "Gender": "Other", "Age": 40,
+                   "Brushing Habit": "Twice a day", "Smoking Status": "No",
+                   "Last Dental Appointment": "2023-06-01", "Notes": ""}
+        for _ in range(args.saves):
+            visit_id = timer.time("save_patient", patient_store.add_visit, patient)
+            timer.time("save_summary", patient_store.save_detection_summary, visit_id, "video", counts,
+                       store.frame_count)
+        patient_store.close()
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "cpus": os.cpu_count(),
+            "backend": backend.name,
+            "model": args.model,
+            "weights_hash": backend.weights_hash(),
+            "frame_size": [args.width, args.height],
+            "frames": args.frames,
+            "repeat": args.repeat,
+            "imgsz": args.imgsz,
+            "detections": len(store),
+            "class_shares": {cls: round(share, 4) for cls, share in shares.items()},
+        },
+        "stages": timer.summary(),
+    }
+
+
+def compare(base, new, threshold=THRESHOLD, min_delta_ms=MIN_DELTA_MS):
+    # Returns one row per stage present in both runs, with a flag for regressions
+    rows = []
+    for stage, before in base["stages"].items():
+        after = new["stages"].get(stage)
+        if after is None:
+            continue
+        row = {"stage": stage, "regression": False}
+        for key in ("p50_ms", "p95_ms"):
+            delta = after[key] - before[key]
+            change = delta / before[key] if before[key] else 0.0
+            row[key] = (before[key], after[key], round(change, 4))
+            if change > threshold and delta > min_delta_ms:
+                row["regression"] = True
+        rows.append(row)
+    return rows
+
+
+def print_stages(stages):
+    print(f"{'stage':16s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'per s':>9s}")
+    for stage, entry in stages.items():
+        print(f"{stage:16s} {entry['p50_ms']:9.3f} {entry['p95_ms']:9.3f} {entry['p99_ms']:9.3f} "
+              f"{entry['throughput_per_s'] or 0:9.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage latency benchmark of the detection pipeline on "
+                                                 "synthetic media. Runs headless.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Benchmark every stage and write a JSON report")
+    run_parser.add_argument("--model", default="stub", help="Weights path, or 'stub' for the deterministic stub model")
+    run_parser.add_argument("--backend", default=BACKEND)
+    run_parser.add_argument("--threads", type=int)
+    run_parser.add_argument("--width", type=int, default=1920)
+    run_parser.add_argument("--height", type=int, default=1080)
+    run_parser.add_argument("--fps", type=float, default=30)
+    run_parser.add_argument("--frames", type=int, default=120, help="Length of the synthetic video")
+    run_parser.add_argument("--images", type=int, default=20, help="Number of synthetic JPEG images")
+    run_parser.add_argument("--repeat", type=int, default=1, help="Passes over the video and images")
+    run_parser.add_argument("--aggregate-runs", type=int, default=200)
+    run_parser.add_argument("--saves", type=int, default=50)
+    run_parser.add_argument("--imgsz", type=int, default=IMGSZ)
+    run_parser.add_argument("--output", default="benchmark.json")
+
+    compare_parser = commands.add_parser("compare", help="Flag stages that got slower between two reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                                help="Relative p50/p95 increase that counts as a regression")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=MIN_DELTA_MS)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        report = run(args)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print_stages(report["stages"])
+        print(f"Report written to {args.output}")
+        return 0
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for key in ("backend", "model", "frame_size", "imgsz"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print(f"Warning: runs differ in {key}: {base['meta'].get(key)} vs {new['meta'].get(key)}")
+    rows = compare(base, new, args.threshold, args.min_delta_ms)
+    print(f"{'stage':16s} {'p50 before':>11s} {'after':>9s} {'change':>8s} {'p95 before':>11s} {'after':>9s} "
+          f"{'change':>8s}")
+    for row in rows:
+        (p50_before, p50_after, p50_change), (p95_before, p95_after, p95_change) = row["p50_ms"], row["p95_ms"]
+        print(f"{row['stage']:16s} {p50_before:11.3f} {p50_after:9.3f} {p50_change:+8.1%} {p95_before:11.3f} "
+              f"{p95_after:9.3f} {p95_change:+8.1%}" + ("  REGRESSION" if row["regression"] else ""))
+    regressions = [row["stage"] for row in rows if row["regression"]]
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import namedtuple
+
+import numpy as np
+
+CLASSES = ["Healthy", "Initial", "Moderate", "Extensive"]
+
+# Past this many bytes the columns move from RAM into memory-mapped files
+SPILL_BYTES = int(os.environ.get("CARIES_STORE_SPILL_BYTES", 64 * 1024 * 1024))
+INITIAL_CAPACITY = 1024
+INITIAL_FRAMES = 1024
+# frame_table marker for a frame the scheduler skipped
+SKIPPED = -2
+# Detector hits a track needs before it counts as a lesion in a video
+LESION_MIN_HITS = int(os.environ.get("CARIES_LESION_MIN_HITS", 2))
+EXPORT_CHUNK = 10000
+
+# track is None for untracked detections, else one lesion ID per box
+Detections = namedtuple("Detections", ["xyxy", "conf", "cls", "track"], defaults=[None])
+
+COLUMNS = [
+    ("frame", np.int32, ()),
+    ("xyxy", np.float32, (4,)),
+    ("conf", np.float32, ()),
+    ("cls", np.int16, ()),
+    ("track", np.int32, ()),
+]
+
+
+def empty_detections():
+    return Detections(np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int16))
+
+
+def box_iou(a, b):
+    # Pairwise IoU of two (n, 4) and (m, 4) xyxy arrays -> (n, m)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+
+
+def detections_from_result(result):
+    boxes = result.boxes
+    return Detections(
+        boxes.xyxy.cpu().numpy().astype(np.float32),
+        boxes.conf.cpu().numpy().astype(np.float32),
+        boxes.cls.cpu().numpy().astype(np.int16),
+    )
+
+
+class DetectionStore:
+    # One row per detected box, kept as growable NumPy columns rather than one
+    # ultralytics Results (with its copy of the frame) per frame.
+    def __init__(self, names, spill_bytes=SPILL_BYTES, spill_dir=None):
+        self.names = dict(names)
+        self.spill_bytes = spill_bytes
+        self.spill_dir = spill_dir
+        self.spill_root = None
+        self.spill_path = None
+        self.spill_generation = 0
+        self.size = 0
+        self.capacity = 0
+        self.frame_count = 0
+        # [first row, row count, detected] per frame index; -1 marks a frame not
+        # analyzed yet and SKIPPED one passed over. Lets a replayed frame be served
+        # from the store and counted only once. detected is 0 for a frame whose boxes
+        # were carried forward by the tracker rather than found by the detector.
+        self.frame_table = np.full((INITIAL_FRAMES, 3), -1, np.int64)
+        self.columns = {}
+        self.lock = threading.RLock()
+        self._allocate(INITIAL_CAPACITY)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def spilled(self):
+        return self.spill_path is not None
+
+    @property
+    def nbytes(self):
+        # Memory held, or mapped when spilled
+        return self.capacity * self._row_bytes() + self.frame_table.nbytes
+
+    def _row_bytes(self):
+        return sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in COLUMNS)
+
+    def _allocate(self, capacity):
+        old_columns = self.columns
+        old_path = self.spill_path
+        if capacity * self._row_bytes() > self.spill_bytes:
+            if self.spill_root is None:
+                self.spill_root = tempfile.mkdtemp(prefix="caries_store_", dir=self.spill_dir)
+                weakref.finalize(self, shutil.rmtree, self.spill_root, True)
+            self.spill_generation += 1
+            self.spill_path = os.path.join(self.spill_root, str(self.spill_generation))
+            os.makedirs(self.spill_path)
+            columns = {
+                name: np.lib.format.open_memmap(
+                    os.path.join(self.spill_path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(capacity,) + shape
+                )
+                for name, dtype, shape in COLUMNS
+            }
+        else:
+            columns = {name: np.empty((capacity,) + shape, dtype) for name, dtype, shape in COLUMNS}
+        for name, column in old_columns.items():
+            columns[name][:self.size] = column[:self.size]
+        self.columns = columns
+        self.capacity = capacity
+        old_columns.clear()
+        if old_path:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    def _append(self, frame, xyxy, conf, cls, track):
+        end = self.size + len(conf)
+        if end > self.capacity:
+            capacity = self.capacity
+            while capacity < end:
+                capacity *= 2
+            self._allocate(capacity)
+        self.columns["frame"][self.size:end] = frame
+        self.columns["xyxy"][self.size:end] = xyxy
+        self.columns["conf"][self.size:end] = conf
+        self.columns["cls"][self.size:end] = cls
+        self.columns["track"][self.size:end] = track
+        self.size = end
+
+    def _grow_table(self, frames):
+        if frames > len(self.frame_table):
+            table = np.full((max(frames, 2 * len(self.frame_table)), 3), -1, np.int64)
+            table[:len(self.frame_table)] = self.frame_table
+            self.frame_table = table
+
+    def _mark_frame(self, frame_index, start, count, detected=True):
+        self._grow_table(frame_index + 1)
+        self.frame_table[frame_index] = (start, count, int(detected))
+        self.frame_count += 1
+
+    def mark_skipped(self, start, stop=None):
+        # Frames in [start, stop) that the source produced but nobody analyzed, so the
+        # results can say how much of a video they cover. Analyzed frames are kept.
+        stop = start + 1 if stop is None else stop
+        if stop <= start:
+            return
+        with self.lock:
+            self._grow_table(stop)
+            rows = self.frame_table[start:stop, 0]
+            rows[rows == -1] = SKIPPED
+
+    @property
+    def skipped_frames(self):
+        with self.lock:
+            return int(np.count_nonzero(self.frame_table[:, 0] == SKIPPED))
+
+    def has_frame(self, frame_index):
+        with self.lock:
+            return 0 <= frame_index < len(self.frame_table) and self.frame_table[frame_index, 0] >= 0
+
+    def add(self, frame_index, detections, detected=True):
+        # Returns False, and stores nothing, for a frame that is already in the store
+        with self.lock:
+            if self.has_frame(frame_index):
+                return False
+            self._mark_frame(frame_index, self.size, len(detections.conf), detected)
+            if len(detections.conf):
+                track = -1 if detections.track is None else detections.track
+                self._append(frame_index, detections.xyxy, detections.conf, detections.cls, track)
+            return True
+
+    def frame_detections(self, frame_index):
+        with self.lock:
+            if not self.has_frame(frame_index):
+                return None
+            start, count, _ = self.frame_table[frame_index]
+            return Detections(*(np.array(self.columns[name][start:start + count])
+                                for name in ["xyxy", "conf", "cls", "track"]))
+
+    def save_npz(self, f):
+        with self.lock:
+            np.savez_compressed(
+                f, frames=np.flatnonzero(self.frame_table[:, 0] >= 0),
+                skipped=np.flatnonzero(self.frame_table[:, 0] == SKIPPED),
+                carried=np.flatnonzero((self.frame_table[:, 0] >= 0) & (self.frame_table[:, 2] == 0)),
+                **{name: self.columns[name][:self.size] for name, _, _ in COLUMNS}
+            )
+
+    def load_npz(self, f):
+        with np.load(f) as data:
+            arrays = [data[name] for name, _, _ in COLUMNS]
+            frames = data["frames"]
+            skipped = data["skipped"] if "skipped" in data.files else np.zeros(0, np.int64)
+            carried = set(data["carried"].tolist()) if "carried" in data.files else set()
+        with self.lock:
+            base = self.size
+            self._append(*arrays)
+            # Rows of one frame were always appended together, so they are contiguous
+            frame_ids, starts, counts = np.unique(arrays[0], return_index=True, return_counts=True)
+            rows = {int(i): (base + int(s), int(c)) for i, s, c in zip(frame_ids, starts, counts)}
+            for frame_index in frames:
+                self._mark_frame(int(frame_index), *rows.get(int(frame_index), (base, 0)),
+                                 detected=int(frame_index) not in carried)
+            for frame_index in skipped:
+                self.mark_skipped(int(frame_index))
+
+    def column(self, name):
+        with self.lock:
+            return self.columns[name][:self.size]
+
+    def detections(self):
+        with self.lock:
+            return Detections(self.column("xyxy"), self.column("conf"), self.column("cls"), self.column("track"))
+
+    @property
+    def detected_frames(self):
+        with self.lock:
+            return int(np.count_nonzero((self.frame_table[:, 0] >= 0) & (self.frame_table[:, 2] == 1)))
+
+    def next_track_id(self):
+        with self.lock:
+            return int(self.column("track").max()) + 1 if self.size else 0
+
+    def lesions(self, min_hits=LESION_MIN_HITS):
+        # One entry per tracked lesion: the class with the most detector confidence
+        # behind it, its mean detector confidence and how long it was on screen.
+        # Untracked boxes (still images) are a lesion each. Tracks the detector
+        # confirmed fewer than min_hits times are left out as likely false positives.
+        with self.lock:
+            track = self.column("track").astype(np.int64)
+            frames = self.column("frame")
+            conf = self.column("conf").astype(np.float64)
+            cls = self.column("cls")
+            detected = (self.frame_table[frames, 2] == 1).astype(np.float64)
+        untracked = track < 0
+        track[untracked] = -1 - np.arange(np.count_nonzero(untracked))
+        ids, inverse = np.unique(track, return_inverse=True)
+        if not len(ids):
+            return []
+        hits = np.bincount(inverse, weights=detected, minlength=len(ids))
+        seen = np.bincount(inverse, minlength=len(ids))
+        confidence = np.bincount(inverse, weights=conf * detected, minlength=len(ids)) / np.maximum(hits, 1)
+        class_ids = np.unique(cls)
+        votes = np.stack([np.bincount(inverse, weights=conf * detected * (cls == c), minlength=len(ids))
+                          for c in class_ids])
+        first = np.full(len(ids), np.iinfo(np.int64).max)
+        last = np.full(len(ids), -1)
+        np.minimum.at(first, inverse, frames)
+        np.maximum.at(last, inverse, frames)
+        return [
+            {"track": int(ids[i]) if ids[i] >= 0 else None, "class": self.label(class_ids[votes[:, i].argmax()]),
+             "confidence": float(confidence[i]), "hits": int(hits[i]), "frames": int(seen[i]),
+             "first_frame": int(first[i]), "last_frame": int(last[i])}
+            for i in np.argsort(first, kind="stable") if hits[i] >= min_hits
+        ]
+
+    def lesion_counts(self, min_hits=LESION_MIN_HITS):
+        counts = {cls: 0 for cls in CLASSES}
+        for lesion in self.lesions(min_hits):
+            if lesion["class"] in counts:
+                counts[lesion["class"]] += 1
+        return counts
+
+    def label(self, class_id):
+        return self.names.get(int(class_id), str(class_id))
+
+    def class_counts(self):
+        counts = {cls: 0 for cls in CLASSES}
+        ids, totals = np.unique(self.column("cls"), return_counts=True)
+        for class_id, total in zip(ids, totals):
+            label = self.label(class_id)
+            if label in counts:
+                counts[label] += int(total)
+        return counts
+
+    def export_csv(self, path):
+        with self.lock:
+            size = self.size
+            columns = self.columns
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["frame", "x1", "y1", "x2", "y2", "confidence", "class", "track"])
+                for start in range(0, size, EXPORT_CHUNK):
+                    end = min(start + EXPORT_CHUNK, size)
+                    xyxy = columns["xyxy"][start:end]
+                    writer.writerows(
+                        (int(frame), *(f"{v:.1f}" for v in box), f"{conf:.4f}", self.label(cls),
+                         int(track) if track >= 0 else "")
+                        for frame, box, conf, cls, track in zip(
+                            columns["frame"][start:end], xyxy, columns["conf"][start:end], columns["cls"][start:end],
+                            columns["track"][start:end]
+                        )
+                    )
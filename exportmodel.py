@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import cv2
+import numpy as np
+
+from backends import IMGSZ, PyTorchBackend, create_backend, preprocess
+from detectionstore import box_iou
+from mediafiles import list_images
+from modelmanager import MODEL_PATH
+
+MATCH_IOU = 0.5
+
+
+def load_images(folder, limit):
+    images = [cv2.imread(path) for path in list_images(folder)[:limit]]
+    return [img for img in images if img is not None]
+
+
+def export_onnx(weights, imgsz):
+    from ultralytics import YOLO
+
+    # Dynamic axes so the app can batch frames through one session run
+    return YOLO(weights).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=False)
+
+
+def export_openvino(weights, imgsz):
+    from ultralytics import YOLO
+
+    return YOLO(weights).export(format="openvino", imgsz=imgsz, dynamic=True)
+
+
+def quantize_onnx(onnx_path, calibration, imgsz):
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class Reader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.batches = iter(preprocess([img], imgsz)[0] for img in calibration)
+            self.input_name = input_name
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {self.input_name: batch}
+
+    import onnx
+
+    input_name = onnx.load(onnx_path, load_external_data=False).graph.input[0].name
+    output_path = onnx_path.replace(".onnx", "_int8.onnx")
+    quantize_static(onnx_path, output_path, Reader(input_name), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    # Keep the class names the backend reads from the model metadata
+    model = onnx.load(output_path)
+    source = onnx.load(onnx_path, load_external_data=False)
+    del model.metadata_props[:]
+    model.metadata_props.extend(source.metadata_props)
+    onnx.save(model, output_path)
+    return output_path
+
+
+def quantize_openvino(openvino_dir, calibration, imgsz):
+    import nncf
+    import openvino
+
+    backend = create_backend(openvino_dir, "openvino")
+    model = openvino.Core().read_model(backend.xml_path())
+    dataset = nncf.Dataset(calibration, lambda img: preprocess([img], imgsz)[0])
+    quantized = nncf.quantize(model, dataset, preset=nncf.QuantizationPreset.MIXED,
+                              subset_size=len(calibration))
+    output_dir = openvino_dir.rstrip("/\\").replace("_openvino_model", "_int8_openvino_model")
+    os.makedirs(output_dir, exist_ok=True)
+    openvino.save_model(quantized, os.path.join(output_dir, os.path.basename(backend.xml_path())))
+    metadata = os.path.join(openvino_dir, "metadata.yaml")
+    if os.path.exists(metadata):
+        shutil.copy(metadata, output_dir)
+    return output_dir
+
+
+def agreement(reference, candidate):
+    # Precision/recall/F1 of candidate boxes against the PyTorch boxes on the same
+    # images: same class and IoU >= MATCH_IOU, greedy by confidence
+    matched = total_reference = total_candidate = 0
+    for ref, cand in zip(reference, candidate):
+        total_reference += len(ref.conf)
+        total_candidate += len(cand.conf)
+        if not len(ref.conf) or not len(cand.conf):
+            continue
+        iou = box_iou(cand.xyxy, ref.xyxy)
+        iou[cand.cls[:, None] != ref.cls[None, :]] = 0
+        used = np.zeros(len(ref.conf), bool)
+        for i in np.argsort(-cand.conf):
+            candidates = np.where(~used & (iou[i] >= MATCH_IOU))[0]
+            if len(candidates):
+                used[candidates[iou[i, candidates].argmax()]] = True
+                matched += 1
+    precision = matched / total_candidate if total_candidate else 1.0
+    recall = matched / total_reference if total_reference else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": round(precision, 4), "recall": round(recall, 4), "f1": round(f1, 4)}
+
+
+def measure(backend, images, runs):
+    backend.predict(images[:1])
+    timings, outputs = [], []
+    for _ in range(runs):
+        outputs = []
+        for img in images:
+            started = time.perf_counter()
+            outputs.extend(backend.predict([img]))
+            timings.append((time.perf_counter() - started) * 1000)
+    return outputs, {"median_ms": round(float(np.median(timings)), 2),
+                     "p95_ms": round(float(np.percentile(timings, 95)), 2)}
+
+
+def map50_95(path, data, imgsz):
+    from ultralytics import YOLO
+
+    return round(float(YOLO(path, task="detect").val(data=data, imgsz=imgsz, batch=1, device="cpu",
+                                                     verbose=False).box.map), 4)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export best.pt to ONNX/OpenVINO (optionally INT8) and compare "
+                                                 "each format with the PyTorch model.")
+    parser.add_argument("--weights", default=MODEL_PATH)
+    parser.add_argument("--formats", nargs="+", default=["onnx", "openvino"], choices=["onnx", "openvino"])
+    parser.add_argument("--int8", action="store_true", help="Also write post-training INT8 versions")
+    parser.add_argument("--calibration", help="Folder of representative images for INT8 calibration")
+    parser.add_argument("--calibration-size", type=int, default=300)
+    parser.add_argument("--eval", help="Folder of images for latency/agreement (default: calibration folder)")
+    parser.add_argument("--eval-size", type=int, default=100)
+    parser.add_argument("--data", help="Dataset yaml; if given, mAP50-95 is measured for every format")
+    parser.add_argument("--imgsz", type=int, default=IMGSZ)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--report", default="export_report.json")
+    args = parser.parse_args(argv)
+    if args.int8 and not args.calibration:
+        parser.error("--int8 needs --calibration")
+
+    artifacts = {}
+    exporters = {"onnx": export_onnx, "openvino": export_openvino}
+    quantizers = {"onnx": quantize_onnx, "openvino": quantize_openvino}
+    calibration = load_images(args.calibration, args.calibration_size) if args.calibration else []
+    for fmt in args.formats:
+        artifacts[fmt] = exporters[fmt](args.weights, args.imgsz)
+        if args.int8:
+            artifacts[f"{fmt}-int8"] = quantizers[fmt](artifacts[fmt], calibration, args.imgsz)
+
+    report = {"weights": args.weights, "imgsz": args.imgsz, "formats": {}}
+    eval_folder = args.eval or args.calibration
+    images = load_images(eval_folder, args.eval_size) if eval_folder else []
+    baseline = PyTorchBackend(args.weights)
+    baseline.load()
+    entries = [("pytorch", args.weights, baseline)]
+    for label, path in artifacts.items():
+        backend = create_backend(path)
+        backend.load()
+        entries.append((label, path, backend))
+
+    reference = None
+    for label, path, backend in entries:
+        entry = {"path": path}
+        if images:
+            outputs, entry["latency"] = measure(backend, images, args.runs)
+            outputs = outputs[:len(images)]
+            if reference is None:
+                reference = outputs
+            entry["agreement_vs_pytorch"] = agreement(reference, outputs)
+        if args.data:
+            entry["map50_95"] = map50_95(path, args.data, args.imgsz)
+        report["formats"][label] = entry
+
+    base = report["formats"]["pytorch"]
+    for label, entry in report["formats"].items():
+        if "latency" in entry:
+            entry["speedup_vs_pytorch"] = round(base["latency"]["median_ms"] / entry["latency"]["median_ms"], 2)
+        if "map50_95" in entry:
+            entry["map50_95_delta"] = round(entry["map50_95"] - base["map50_95"], 4)
+        print(f"{label:14s} " + " ".join(
+            f"{key}={value}" for key, value in entry.items() if key != "path"))
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+from PIL import Image
+from PySide6.QtCore import QObject, Signal
+
+from backends import IMGSZ
+from detectionstore import DetectionStore
+from mediafiles import JPEG_EXTENSIONS
+from render import FrameRenderer
+
+# Images after / before the one shown that are decoded and detected in advance
+PREFETCH_AHEAD = int(os.environ.get("CARIES_PREFETCH_AHEAD", 3))
+PREFETCH_BEHIND = 1
+# Memory the finished neighbours may hold; the shown image is always kept
+PREFETCH_MB = float(os.environ.get("CARIES_PREFETCH_MB", 64))
+REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# store holds detections in original image pixels; preview is the buffer q_img wraps
+ImageResult = namedtuple("ImageResult", "path store preview q_img factor timings")
+
+
+def reduction_factor(path, min_side):
+    # Largest JPEG DCT scale (1/2, 1/4, 1/8) that still leaves min_side pixels on the
+    # long side. Only the header is read.
+    if not min_side or not path.lower().endswith(JPEG_EXTENSIONS):
+        return 1
+    try:
+        with Image.open(path) as im:
+            long_side = max(im.size)
+    except OSError:
+        return 1
+    for factor in (8, 4, 2):
+        if long_side / factor >= min_side:
+            return factor
+    return 1
+
+
+def decode_image(path, min_side=IMGSZ):
+    # Returns (BGR image, factor); multiply boxes by factor for original pixels
+    factor = reduction_factor(path, min_side)
+    img = cv2.imread(path, REDUCED_FLAGS[factor] if factor > 1 else cv2.IMREAD_COLOR)
+    return img, factor
+
+
+class ImageLoader(QObject):
+    # Decodes, detects and renders a list of images on one worker thread. The image
+    # asked for goes first; then its neighbours are done in advance and kept while
+    # they fit in the memory budget, so stepping through a patient's photos only
+    # swaps a pixmap. Decoded pixels are dropped once the preview is drawn.
+    loaded = Signal(int, object)
+    failed = Signal(int, str)
+
+    def __init__(self, paths, detector_factory, names, display_size, cache=None, ahead=PREFETCH_AHEAD,
+                 behind=PREFETCH_BEHIND, budget_mb=PREFETCH_MB):
+        super().__init__()
+        self.paths = paths
+        self.detector_factory = detector_factory
+        self.names = names
+        self.display_size = display_size
+        self.cache = cache
+        self.ahead = ahead
+        self.behind = behind
+        self.budget = budget_mb * 2 ** 20
+        self.results = {}
+        self.errors = {}
+        self.current = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="image-loader", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # No new image is started; the one in flight is finished first, so the next
+        # loader never runs predict on the shared model at the same time as this one
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def show(self, index):
+        # Emits loaded right away when the image is ready, else once it is
+        with self.condition:
+            self.current = index
+            result = self.results.get(index)
+            error = self.errors.get(index)
+            self._evict()
+            self.condition.notify()
+        if result is not None:
+            self.loaded.emit(index, result)
+        elif error is not None:
+            self.failed.emit(index, error)
+        return result is not None
+
+    def _window(self):
+        # The shown image, then its neighbours nearest first, next before previous
+        order = [self.current]
+        for step in range(1, max(self.ahead, self.behind) + 1):
+            if step <= self.ahead:
+                order.append(self.current + step)
+            if step <= self.behind:
+                order.append(self.current - step)
+        return [i for i in order if 0 <= i < len(self.paths)]
+
+    def _used(self):
+        return sum(result.preview.nbytes + result.store.nbytes for result in self.results.values())
+
+    def _next_job(self):
+        for index in self._window():
+            if index in self.results or index in self.errors:
+                continue
+            if index != self.current and self._used() >= self.budget:
+                return None
+            return index
+        return None
+
+    def _evict(self):
+        window = self._window()
+        for index in list(self.results):
+            if index not in window:
+                del self.results[index]
+        # Farthest neighbours go first
+        for index in reversed(window[1:]):
+            if self._used() <= self.budget:
+                break
+            self.results.pop(index, None)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                index = self._next_job()
+                while index is None and not self.stopped:
+                    self.condition.wait()
+                    index = self._next_job()
+                if self.stopped:
+                    return
+            try:
+                result = self._load(self.paths[index])
+            except Exception as e:
+                with self.condition:
+                    self.errors[index] = str(e)
+                    current = self.current
+                if index == current:
+                    self.failed.emit(index, str(e))
+                continue
+            with self.condition:
+                self.results[index] = result
+                self._evict()
+                current = self.current
+            if index == current:
+                self.loaded.emit(index, result)
+
+    def _load(self, path):
+        started = time.perf_counter()
+        # A fresh detector per photo, since a tiled one keeps the ROI of the last image
+        detector = self.detector_factory()
+        img, factor = decode_image(path, getattr(detector, "source_size", IMGSZ))
+        if img is None:
+            raise ValueError(f"Cannot read image {os.path.basename(path)}")
+        decoded = time.perf_counter()
+        store = DetectionStore(self.names)
+        key = None
+        if self.cache:
+            # A reopened photo is redrawn from cached detections without inference
+            key = self.cache.key(path, source="image", decode_factor=factor, **getattr(detector, "cache_params", {}))
+        if key is None or not self.cache.get(key, store):
+            detections = detector.predict([img])[0]
+            store.add(0, detections._replace(xyxy=detections.xyxy * factor))
+            if key:
+                self.cache.put(key, store)
+        detected = time.perf_counter()
+        detections = store.detections()
+        renderer = FrameRenderer(*self.display_size, self.names, buffers=1)
+        q_img = renderer.render(img, detections._replace(xyxy=detections.xyxy / factor))
+        timings = {"decode": (decoded - started) * 1000, "inference": (detected - decoded) * 1000,
+                   "render": renderer.last_render_ms}
+        return ImageResult(path, store, renderer.buffers[0], q_img, factor, timings)
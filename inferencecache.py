@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import zipfile
+
+CACHE_DIR = os.environ.get("CARIES_CACHE_DIR", ".caries_cache")
+CACHE_MAX_BYTES = int(os.environ.get("CARIES_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class InferenceCache:
+    # Detection outputs on disk, keyed by file content + inference parameters and
+    # grouped in a directory per weights hash. Opening the cache for new weights
+    # deletes the entries made by any other weights. Entries are compressed
+    # DetectionStore arrays; the least recently used ones are evicted once the
+    # directory grows past max_bytes.
+    def __init__(self, weights_hash, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.weights_hash = weights_hash
+        self.max_bytes = max_bytes
+        self.directory = os.path.join(directory, weights_hash[:16])
+        self.lock = threading.Lock()
+        if os.path.isdir(directory):
+            for entry in os.scandir(directory):
+                if entry.is_dir() and entry.path != self.directory:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, path, **params):
+        content = file_digest(path)
+        return hashlib.sha256(f"{content}:{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key, store):
+        # Fills store with the cached detections and returns True on a hit
+        path = self._path(key)
+        try:
+            store.load_npz(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return False
+        try:
+            # mtime doubles as the last-used time for LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def put(self, key, store):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            store.save_npz(f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".npz")]
+            stats = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries]
+            total = sum(size for _, size, _ in stats)
+            for _, size, path in sorted(stats):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
@@ -0,0 +1,282 @@
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from backends import BACKEND, DEFAULT_SERVER_PORT
+from modelmanager import MODEL_PATH, ModelManager
+from perfmetrics import PerfMetrics, to_prometheus
+
+# Longest a request waits for other clients' frames before its batch runs
+LATENCY_BUDGET_MS = float(os.environ.get("CARIES_SERVER_BUDGET_MS", 15))
+MAX_BATCH = int(os.environ.get("CARIES_SERVER_MAX_BATCH", 16))
+# Larger /predict bodies are refused before they are read
+MAX_REQUEST_MB = float(os.environ.get("CARIES_SERVER_MAX_REQUEST_MB", 256))
+# predict() arguments a client may set; anything else is ignored
+PREDICT_ARGS = ("conf", "iou", "max_det")
+
+
+class _Request:
+    __slots__ = ("images", "kwargs", "arrived", "done", "result", "error")
+
+    def __init__(self, images, kwargs):
+        self.images = images
+        self.kwargs = kwargs
+        self.arrived = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Batcher:
+    # One thread owns the model. The first waiting request opens a batch; requests
+    # from any client that arrive within the latency budget, up to max_batch images,
+    # join it and go through a single predict() call.
+    def __init__(self, model, max_batch=MAX_BATCH, budget_ms=LATENCY_BUDGET_MS, metrics=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.budget = budget_ms / 1000
+        self.metrics = metrics
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.errors = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests_total": self.requests,
+            "images_total": self.images,
+            "batches_total": self.batches,
+            "errors_total": self.errors,
+            "mean_batch_images": round(self.images / self.batches, 2) if self.batches else 0,
+        }
+
+    def submit(self, images, kwargs):
+        request = _Request(images, kwargs)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                first = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch = [first]
+            images = len(first.images)
+            deadline = first.arrived + self.budget
+            while images < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                images += len(request.images)
+            self._process(batch)
+
+    def _process(self, batch):
+        groups = {}
+        for request in batch:
+            groups.setdefault(json.dumps(request.kwargs, sort_keys=True), []).append(request)
+        for requests in groups.values():
+            started = time.perf_counter()
+            images = [img for request in requests for img in request.images]
+            try:
+                outputs = self.model.predict(images, **requests[0].kwargs)
+            except Exception as e:
+                if len(requests) > 1:
+                    # One client's frame must not fail everyone it was batched with
+                    for request in requests:
+                        self._process([request])
+                    continue
+                self.errors += 1
+                requests[0].error = str(e)
+                requests[0].done.set()
+                continue
+            finished = time.perf_counter()
+            self.requests += len(requests)
+            self.images += len(images)
+            self.batches += 1
+            if self.metrics:
+                self.metrics.record("batch_inference", (finished - started) * 1000)
+            offset = 0
+            for request in requests:
+                request.result = outputs[offset:offset + len(request.images)]
+                offset += len(request.images)
+                if self.metrics:
+                    self.metrics.record("queue_wait", (started - request.arrived) * 1000)
+                request.done.set()
+
+
+def decode_images(body):
+    with np.load(io.BytesIO(body)) as data:
+        images = [data[f"arr_{i}"] for i in range(len(data.files))]
+    for img in images:
+        if img.ndim != 3 or img.shape[2] != 3 or img.dtype != np.uint8:
+            raise ValueError(f"expected HxWx3 uint8 BGR images, got {img.dtype} {img.shape}")
+    return images
+
+
+def encode_detections(detections):
+    arrays = {}
+    for i, d in enumerate(detections):
+        arrays.update({f"xyxy_{i}": d.xyxy, f"conf_{i}": d.conf, f"cls_{i}": d.cls})
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # GET /health, GET /metrics (Prometheus text), POST /predict (npz of BGR frames
+    # in, npz of xyxy/conf/cls per frame out)
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data).encode(), "application/json")
+
+    def do_GET(self):
+        model = self.server.model
+        if self.path == "/health":
+            self._send_json(200, {
+                "state": model.state,
+                "error": model.error,
+                "model": model.path,
+                "backend": model.backend.name if model.backend else None,
+                "weights_hash": model.weights_hash,
+                "names": model.names,
+                **self.server.batcher.stats(),
+            })
+        elif self.path == "/metrics":
+            self._send(200, to_prometheus(self.server.metrics.snapshot()).encode(), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_REQUEST_MB * 2 ** 20:
+            # The body stays unread, so this connection cannot carry another request
+            self.close_connection = True
+            if length < 0:
+                self._send_json(400, {"error": "bad request: missing or invalid Content-Length"})
+            else:
+                self._send_json(413, {"error": f"request larger than {MAX_REQUEST_MB:g} MB"})
+            return
+        body = self.rfile.read(length)
+        if self.path != "/predict":
+            self._send_json(404, {"error": "not found"})
+            return
+        if not self.server.model.ready:
+            self._send_json(503, {"error": f"model {self.server.model.state}"})
+            return
+        started = time.perf_counter()
+        try:
+            images = decode_images(body)
+            kwargs = json.loads(self.headers.get("X-Predict-Args") or "{}")
+            if not isinstance(kwargs, dict):
+                raise ValueError("X-Predict-Args must be a JSON object")
+            kwargs = {key: value for key, value in kwargs.items() if key in PREDICT_ARGS}
+        except (ValueError, KeyError, EOFError, OSError, zipfile.BadZipFile) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+        try:
+            detections = self.server.batcher.submit(images, kwargs)
+        except RuntimeError as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send(200, encode_detections(detections), "application/octet-stream")
+        self.server.metrics.record("request", (time.perf_counter() - started) * 1000)
+
+    def log_message(self, format, *args):
+        # One line per frame would drown everything else
+        pass
+
+
+class UnixInferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(model, host="127.0.0.1", port=DEFAULT_SERVER_PORT, unix_socket=None, max_batch=MAX_BATCH,
+          budget_ms=LATENCY_BUDGET_MS, metrics_file=None):
+    # Returns the running server; the caller owns serve_forever()/shutdown()
+    metrics = PerfMetrics(enabled=True, path=metrics_file)
+    batcher = Batcher(model, max_batch, budget_ms, metrics)
+    metrics.set_source("server", batcher.stats)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixInferenceServer(unix_socket, InferenceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.model = model
+    server.batcher = batcher
+    server.metrics = metrics
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the caries detector to several workstations on this machine, "
+                                                 "batching their frames together.")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--backend", default=BACKEND)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT)
+    parser.add_argument("--unix", help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--budget-ms", type=float, default=LATENCY_BUDGET_MS,
+                        help="How long a frame may wait for others to share its batch")
+    parser.add_argument("--metrics-file", help="Also write metrics to this file periodically")
+    args = parser.parse_args(argv)
+
+    model = ModelManager(args.model, args.backend, args.threads)
+    model.start()
+    server = serve(model, args.host, args.port, args.unix, args.max_batch, args.budget_ms, args.metrics_file)
+    address = f"unix://{args.unix}" if args.unix else f"http://{args.host}:{args.port}"
+    print(f"Serving {args.model} on {address} (loading in the background)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.stop()
+        server.metrics.stop()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+
+# File types the app, the batch CLI and the tools accept
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov")
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+
+def list_images(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTENSIONS))
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from backends import BACKEND, create_backend
+
+MODEL_PATH = os.environ.get("CARIES_MODEL", r"C:\Users\muham\Documents\software_development\best.pt")
+WARMUP_SIZE = 640
+STARTUP_LOG = os.environ.get("CARIES_STARTUP_LOG", "startup_times.jsonl")
+
+
+class StartupTimer:
+    # Seconds since the app module started importing, one entry per milestone
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.marks = {}
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = round(time.perf_counter() - self.started, 4)
+
+    def write(self, path=STARTUP_LOG):
+        if not self.marks:
+            return
+        with open(path, "a") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), **self.marks}) + "\n")
+
+
+startup_timer = StartupTimer()
+
+
+class ModelManager:
+    # Owns the detector. Weights are loaded and warmed up on a background thread;
+    # listeners are called with the new state ("idle", "loading", "warming",
+    # "ready" or "error") from that thread.
+    def __init__(self, path=MODEL_PATH, backend=BACKEND, threads=None):
+        self.path = path
+        self.backend_name = backend
+        self.threads = threads
+        self.backend = None
+        self.weights_hash = None
+        self.state = "idle"
+        self.error = None
+        self.listeners = []
+        self.ready_event = threading.Event()
+        self.thread = None
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    @property
+    def names(self):
+        return self.backend.names if self.backend is not None else {}
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _set_state(self, state):
+        self.state = state
+        for listener in self.listeners:
+            listener(state)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.load, name="model-loader", daemon=True)
+            self.thread.start()
+
+    def switch(self, path, backend=BACKEND):
+        # Loads other weights, or connects to an inference server, in the background.
+        # The current backend keeps answering until the new one is warm.
+        if self.thread is not None and self.thread.is_alive():
+            return False
+        self.path = path
+        self.backend_name = backend
+        self.error = None
+        self.ready_event.clear()
+        self.thread = threading.Thread(target=self.load, name="model-loader", daemon=True)
+        self.thread.start()
+        return True
+
+    def load(self):
+        self._set_state("loading")
+        try:
+            backend = create_backend(self.path, self.backend_name, self.threads)
+            backend.load()
+            weights_hash = backend.weights_hash()
+            startup_timer.mark("model_loaded")
+            self._set_state("warming")
+            # The first call pays for graph setup and backend selection; do it here
+            # rather than on the first real frame.
+            backend.predict([np.zeros((WARMUP_SIZE, WARMUP_SIZE, 3), np.uint8)])
+            startup_timer.mark("model_warm")
+            self.backend = backend
+            self.weights_hash = weights_hash
+        except Exception as e:
+            self.error = str(e)
+            self._set_state("error")
+        else:
+            self._set_state("ready")
+        finally:
+            self.ready_event.set()
+        return self.backend
+
+    def wait(self, timeout=None):
+        self.ready_event.wait(timeout)
+        return self.ready
+
+    def predict(self, images, **kwargs):
+        if self.backend is None:
+            raise RuntimeError(f"Model is not ready ({self.state})")
+        detections = self.backend.predict(images, **kwargs)
+        startup_timer.mark("first_detection")
+        return detections
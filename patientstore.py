@@ -0,0 +1,440 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import quote
+
+from detectionstore import CLASSES
+
+DEFAULT_PATIENT_STORE = "sqlite:///caries_patients.db"
+PATIENT_STORE = os.environ.get("CARIES_PATIENT_STORE", DEFAULT_PATIENT_STORE)
+EXCEL_FILE = "caries_patients.xlsx"
+EXPORT_CHUNK = 1000
+
+# Form label -> column name
+PATIENT_FIELDS = [
+    ("Date", "date"),
+    ("Name", "name"),
+    ("Gender", "gender"),
+    ("Age", "age"),
+    ("Brushing Habit", "brushing_habit"),
+    ("Smoking Status", "smoking_status"),
+    ("Last Dental Appointment", "last_dental_appointment"),
+    ("Notes", "notes"),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    gender TEXT,
+    age INTEGER,
+    brushing_habit TEXT,
+    smoking_status TEXT,
+    last_dental_appointment TEXT,
+    notes TEXT,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS visits_name ON visits (name);
+CREATE INDEX IF NOT EXISTS visits_date ON visits (date);
+CREATE TABLE IF NOT EXISTS detection_summaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    visit_id INTEGER NOT NULL REFERENCES visits (id),
+    mode TEXT,
+    frames INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS detection_summaries_visit ON detection_summaries (visit_id);
+CREATE TABLE IF NOT EXISTS detection_counts (
+    summary_id INTEGER NOT NULL REFERENCES detection_summaries (id),
+    class_name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (summary_id, class_name)
+);
+CREATE TABLE IF NOT EXISTS analytics_visits (
+    period TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    visits INTEGER NOT NULL,
+    PRIMARY KEY (period, dimension, value)
+);
+CREATE INDEX IF NOT EXISTS analytics_visits_dimension ON analytics_visits (dimension, value);
+CREATE TABLE IF NOT EXISTS analytics_counts (
+    period TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    class_name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (period, dimension, value, class_name)
+);
+"""
+
+# Rollup dimensions: the whole clinic, then one per patient field
+ANALYTICS_DIMENSIONS = [
+    ("all", "Overall"),
+    ("gender", "Gender"),
+    ("age_band", "Age band"),
+    ("brushing_habit", "Brushing Habit"),
+    ("smoking_status", "Smoking Status"),
+    ("last_dental_appointment", "Last Dental Appointment"),
+]
+# Lower bound of each age band
+AGE_BANDS = [(0, "0-12"), (13, "13-17"), (18, "18-34"), (35, "35-54"), (55, "55-74"), (75, "75+")]
+
+
+def age_band(age):
+    if age is None or age == "":
+        return "Unknown"
+    band = AGE_BANDS[0][1]
+    for lower, label in AGE_BANDS:
+        if int(age) >= lower:
+            band = label
+    return band
+
+
+def visit_periods(date):
+    # "all", then year, quarter and month of a yyyy-mm-dd date
+    periods = ["all"]
+    year, _, rest = str(date or "").partition("-")
+    if year.isdigit():
+        periods.append(year)
+        month = rest[:2]
+        if month.isdigit() and 1 <= int(month) <= 12:
+            periods += [f"{year}-Q{(int(month) - 1) // 3 + 1}", f"{year}-{month}"]
+    return periods
+
+
+def current_periods(date=None):
+    # {"year": ..., "quarter": ..., "month": ...} for today, as analytics() period keys
+    date = date or time.strftime("%Y-%m-%d")
+    _, year, quarter, month = visit_periods(date)
+    return {"year": year, "quarter": quarter, "month": month}
+
+
+class PatientStore(ABC):
+    @abstractmethod
+    def add_visit(self, data):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_detection_summary(self, visit_id, mode, counts, frames=0):
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_visits(self, date_from=None, date_to=None, chunk_size=EXPORT_CHUNK):
+        # Yields lists of (visit_id, patient_data, latest class counts or None)
+        raise NotImplementedError
+
+    @abstractmethod
+    def visit(self, visit_id):
+        # patient_data of one visit, or None
+        raise NotImplementedError
+
+    @abstractmethod
+    def latest_summary(self, visit_id):
+        # {"mode", "frames", "created_at", "counts"} of the newest summary, or None
+        raise NotImplementedError
+
+    @abstractmethod
+    def analytics(self, period="all", dimension="all"):
+        # {value: {"visits": n, "counts": {class: n}}} over the latest summary of
+        # every analyzed visit in period, read from the rollups
+        raise NotImplementedError
+
+    @abstractmethod
+    def analytics_periods(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def export_xlsx(self, path=EXCEL_FILE, date_from=None, date_to=None, chunk_size=EXPORT_CHUNK):
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Patients")
+        sheet.append([label for label, _ in PATIENT_FIELDS] + CLASSES)
+        rows = 0
+        for chunk in self.iter_visits(date_from, date_to, chunk_size):
+            for _, data, counts in chunk:
+                counts = counts or {}
+                sheet.append([data[label] for label, _ in PATIENT_FIELDS] + [counts.get(cls) for cls in CLASSES])
+                rows += 1
+        tmp_path = f"{path}.tmp"
+        workbook.save(tmp_path)
+        os.replace(tmp_path, path)
+        return rows
+
+    def import_xlsx(self, path=EXCEL_FILE):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(path, read_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return 0
+        imported = 0
+        for row in rows:
+            data = dict(zip(header, row))
+            if data.get("Name"):
+                self.add_visit({label: data.get(label) for label, _ in PATIENT_FIELDS})
+                imported += 1
+        workbook.close()
+        return imported
+
+
+class SQLitePatientStore(PatientStore):
+    def __init__(self, path, create=True):
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit mode; every write opens its own BEGIN IMMEDIATE transaction so
+        # several app windows and report runs on one machine serialize on the write
+        # lock instead of overwriting each other. WAL relies on shared memory, so the
+        # file must stay on a local disk: never put it on a network share.
+        if create:
+            self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        else:
+            # mode=rw: a mistyped path is an error, not a new empty database
+            self.conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=rw", timeout=30,
+                                        isolation_level=None, check_same_thread=False, uri=True)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        with self.transaction() as conn:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            # Summaries saved before the rollups existed
+            if conn.execute("SELECT 1 FROM detection_summaries LIMIT 1").fetchone() and \
+                    not conn.execute("SELECT 1 FROM analytics_visits LIMIT 1").fetchone():
+                self._rebuild_analytics(conn)
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def add_visit(self, data):
+        columns = [column for _, column in PATIENT_FIELDS]
+        values = [data.get(label) for label, _ in PATIENT_FIELDS]
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO visits ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", values
+            )
+            return cursor.lastrowid
+
+    def save_detection_summary(self, visit_id, mode, counts, frames=0):
+        with self.transaction() as conn:
+            # Only a visit's latest summary is counted, so a re-save replaces the
+            # previous one in the rollups
+            previous = conn.execute(
+                "SELECT id FROM detection_summaries WHERE visit_id = ? ORDER BY id DESC LIMIT 1", (visit_id,)
+            ).fetchone()
+            keys = self._analytics_keys(conn, visit_id)
+            if previous:
+                old_counts = dict(conn.execute(
+                    "SELECT class_name, count FROM detection_counts WHERE summary_id = ?", (previous[0],)
+                ).fetchall())
+                self._add_to_analytics(conn, keys, old_counts, -1)
+            self._add_to_analytics(conn, keys, counts, 1)
+            cursor = conn.execute(
+                "INSERT INTO detection_summaries (visit_id, mode, frames) VALUES (?, ?, ?)", (visit_id, mode, frames)
+            )
+            summary_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO detection_counts (summary_id, class_name, count) VALUES (?, ?, ?)",
+                [(summary_id, cls, int(count)) for cls, count in counts.items()],
+            )
+            return summary_id
+
+    def _analytics_keys(self, conn, visit_id):
+        columns = [dimension for dimension, _ in ANALYTICS_DIMENSIONS[1:] if dimension != "age_band"]
+        row = conn.execute(f"SELECT date, age, {', '.join(columns)} FROM visits WHERE id = ?", (visit_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No visit {visit_id}")
+        values = [("all", "all"), ("age_band", age_band(row[1]))]
+        values += [(column, value or "Unknown") for column, value in zip(columns, row[2:])]
+        return [(period, dimension, str(value)) for period in visit_periods(row[0]) for dimension, value in values]
+
+    def _add_to_analytics(self, conn, keys, counts, sign):
+        conn.executemany(
+            "INSERT INTO analytics_visits (period, dimension, value, visits) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (period, dimension, value) DO UPDATE SET visits = visits + excluded.visits",
+            [key + (sign,) for key in keys],
+        )
+        conn.executemany(
+            "INSERT INTO analytics_counts (period, dimension, value, class_name, count) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (period, dimension, value, class_name) DO UPDATE SET count = count + excluded.count",
+            [key + (cls, sign * int(count)) for key in keys for cls, count in counts.items()],
+        )
+
+    def _rebuild_analytics(self, conn):
+        conn.execute("DELETE FROM analytics_visits")
+        conn.execute("DELETE FROM analytics_counts")
+        latest = conn.execute("SELECT visit_id, MAX(id) FROM detection_summaries GROUP BY visit_id").fetchall()
+        for visit_id, summary_id in latest:
+            counts = dict(conn.execute(
+                "SELECT class_name, count FROM detection_counts WHERE summary_id = ?", (summary_id,)
+            ).fetchall())
+            self._add_to_analytics(conn, self._analytics_keys(conn, visit_id), counts, 1)
+        return len(latest)
+
+    def rebuild_analytics(self):
+        with self.transaction() as conn:
+            return self._rebuild_analytics(conn)
+
+    def analytics(self, period="all", dimension="all"):
+        # Primary-key range reads: the cost depends on the number of distinct
+        # values in the dimension, not on the number of visits
+        with self.lock:
+            visits = self.conn.execute(
+                "SELECT value, visits FROM analytics_visits WHERE period = ? AND dimension = ? AND visits > 0",
+                (period, dimension),
+            ).fetchall()
+            counts = self.conn.execute(
+                "SELECT value, class_name, count FROM analytics_counts WHERE period = ? AND dimension = ?",
+                (period, dimension),
+            ).fetchall()
+        result = {value: {"visits": n, "counts": {cls: 0 for cls in CLASSES}} for value, n in visits}
+        for value, cls, count in counts:
+            if value in result:
+                result[value]["counts"][cls] = count
+        return result
+
+    def analytics_periods(self):
+        # Newest year first, each year followed by its quarters and months; "all" last
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT period FROM analytics_visits WHERE dimension = 'all' AND value = 'all' AND visits > 0"
+            ).fetchall()
+        periods = sorted((row[0] for row in rows if row[0] != "all"),
+                         key=lambda period: (period[:4], len(period) == 4, "Q" in period, period), reverse=True)
+        return periods + ["all"]
+
+    def latest_counts(self, visit_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT class_name, count FROM detection_counts WHERE summary_id = "
+                "(SELECT MAX(id) FROM detection_summaries WHERE visit_id = ?)",
+                (visit_id,),
+            ).fetchall()
+        return dict(rows) if rows else None
+
+    def visit(self, visit_id):
+        columns = [column for _, column in PATIENT_FIELDS]
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(columns)} FROM visits WHERE id = ?", (visit_id,)).fetchone()
+        return {label: value for (label, _), value in zip(PATIENT_FIELDS, row)} if row else None
+
+    def latest_summary(self, visit_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, mode, frames, created_at FROM detection_summaries WHERE visit_id = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (visit_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            counts = self.conn.execute(
+                "SELECT class_name, count FROM detection_counts WHERE summary_id = ?", (row[0],)
+            ).fetchall()
+        return {"mode": row[1], "frames": row[2], "created_at": row[3], "counts": dict(counts)}
+
+    def iter_visits(self, date_from=None, date_to=None, chunk_size=EXPORT_CHUNK):
+        columns = [column for _, column in PATIENT_FIELDS]
+        where, params = [], []
+        if date_from:
+            where.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("date <= ?")
+            params.append(date_to)
+        query = f"SELECT id, {', '.join(columns)} FROM visits"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        # Keyset pagination keeps each chunk an index range scan and avoids holding
+        # a read transaction open while the caller writes the chunk out.
+        last_id = 0
+        while True:
+            page_query = query + (" AND" if where else " WHERE") + " id > ? ORDER BY id LIMIT ?"
+            with self.lock:
+                rows = self.conn.execute(page_query, params + [last_id, chunk_size]).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [
+                (row[0], {label: value for (label, _), value in zip(PATIENT_FIELDS, row[1:])}, self.latest_counts(row[0]))
+                for row in rows
+            ]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class _Transaction:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        try:
+            self.store.conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.store.lock.release()
+            raise
+        return self.store.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.store.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.store.lock.release()
+
+
+STORE_BACKENDS = {
+    "sqlite": SQLitePatientStore,
+}
+
+
+def open_patient_store(url=None):
+    # The configured store (CARIES_PATIENT_STORE) is created on first use; a store
+    # named explicitly, e.g. by --store, must already exist
+    create = url is None
+    url = PATIENT_STORE if url is None else url
+    scheme, separator, location = url.partition("://")
+    if not separator:
+        # A bare path is a SQLite file
+        scheme, location = "sqlite", url
+    elif scheme == "sqlite":
+        # sqlite:///relative.db and sqlite:////absolute.db, as in SQLAlchemy URLs
+        location = location[1:]
+    if scheme not in STORE_BACKENDS:
+        raise ValueError(f"Unknown patient store '{scheme}'")
+    if not create and scheme == "sqlite" and not os.path.exists(location):
+        raise FileNotFoundError(f"Patient store {location} does not exist")
+    is_new = scheme == "sqlite" and not os.path.exists(location)
+    store = STORE_BACKENDS[scheme](location, create)
+    # First run after the switch from the spreadsheet: carry the old rows over
+    if is_new and url == DEFAULT_PATIENT_STORE and os.path.exists(EXCEL_FILE):
+        store.import_xlsx(EXCEL_FILE)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export patient visits to Excel.")
+    parser.add_argument("output", nargs="?", default=EXCEL_FILE)
+    parser.add_argument("--store", help=f"Existing patient store (default: {PATIENT_STORE})")
+    parser.add_argument("--from", dest="date_from")
+    parser.add_argument("--to", dest="date_to")
+    parser.add_argument("--rebuild-analytics", action="store_true", help="Recompute the analytics rollups and exit")
+    args = parser.parse_args()
+    try:
+        patient_store = open_patient_store(args.store)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    if args.rebuild_analytics:
+        print(f"Rebuilt analytics from {patient_store.rebuild_analytics()} analyzed visits")
+        raise SystemExit
+    count = patient_store.export_xlsx(args.output, args.date_from, args.date_to)
+    print(f"Exported {count} visits to {args.output}")
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+PERF_ENABLED = os.environ.get("CARIES_PERF", "0") == "1"
+PERF_OVERLAY = os.environ.get("CARIES_PERF_OVERLAY", "0") == "1"
+# Snapshots are only written when a file is named
+METRICS_FILE = os.environ.get("CARIES_METRICS_FILE", "")
+# "prometheus" rewrites the file with the latest values, for a node_exporter
+# textfile collector; "jsonl" appends one snapshot per interval
+METRICS_FORMAT = os.environ.get("CARIES_METRICS_FORMAT") or (
+    "jsonl" if METRICS_FILE.endswith(".jsonl") else "prometheus")
+METRICS_INTERVAL = float(os.environ.get("CARIES_METRICS_INTERVAL", 5))
+# Latency samples kept per stage, and how far back the FPS is measured
+WINDOW = 300
+FPS_WINDOW = 2.0
+MAX_IN_FLIGHT = 64
+
+
+def process_rss():
+    try:
+        import psutil
+    except ImportError:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+    return psutil.Process().memory_info().rss
+
+
+class PerfMetrics:
+    # Rolling per-stage latencies and frame rate for the live preview. Every hook
+    # sits behind "if perf.enabled", so a disabled instance costs one attribute
+    # check per stage. Sources are callables returning flat dicts of numbers
+    # (queue depths, drop counters) that are read when a snapshot is taken.
+    def __init__(self, enabled=PERF_ENABLED, path=METRICS_FILE, fmt=METRICS_FORMAT, interval=METRICS_INTERVAL):
+        if fmt not in ("prometheus", "jsonl"):
+            raise ValueError(f"Unknown metrics format '{fmt}'")
+        self.enabled = False
+        self.path = path
+        self.format = fmt
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.sources = {}
+        self.shown = deque()
+        self.frames_shown = 0
+        self.in_flight = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        self.enabled = True
+        if self.thread is None and self.path:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._write_loop, name="perf-metrics", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.enabled = False
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def set_source(self, name, source):
+        with self.lock:
+            if source is None:
+                self.sources.pop(name, None)
+            else:
+                self.sources[name] = source
+
+    def record(self, stage, ms):
+        samples = self.stages.get(stage)
+        if samples is None:
+            samples = self.stages.setdefault(stage, deque(maxlen=WINDOW))
+        samples.append(ms)
+
+    def mark_captured(self, frame_index):
+        with self.lock:
+            self.in_flight[frame_index] = time.perf_counter()
+            if len(self.in_flight) > MAX_IN_FLIGHT:
+                # Frames dropped by a live pipeline never reach the screen
+                del self.in_flight[next(iter(self.in_flight))]
+
+    def frame_shown(self, frame_index):
+        now = time.perf_counter()
+        with self.lock:
+            captured = self.in_flight.pop(frame_index, None)
+            self.shown.append(now)
+            while self.shown[0] < now - FPS_WINDOW:
+                self.shown.popleft()
+            self.frames_shown += 1
+        if captured is not None:
+            self.record("end_to_end", (now - captured) * 1000)
+
+    def fps(self):
+        with self.lock:
+            if len(self.shown) < 2:
+                return 0.0
+            span = self.shown[-1] - self.shown[0]
+            return (len(self.shown) - 1) / span if span > 0 else 0.0
+
+    def snapshot(self):
+        stages = {}
+        for stage, samples in list(self.stages.items()):
+            timings = np.array(list(samples))
+            if not len(timings):
+                continue
+            p50, p95 = np.percentile(timings, [50, 95])
+            stages[stage] = {"last_ms": round(float(timings[-1]), 3), "p50_ms": round(float(p50), 3),
+                             "p95_ms": round(float(p95), 3)}
+        with self.lock:
+            sources = dict(self.sources)
+        gauges = {}
+        for name, source in sources.items():
+            for key, value in source().items():
+                gauges[f"{name}_{key}"] = value
+        return {
+            "time": time.time(),
+            "fps": round(self.fps(), 2),
+            "frames_shown": self.frames_shown,
+            "rss_bytes": process_rss(),
+            "stages": stages,
+            "gauges": gauges,
+        }
+
+    def write(self):
+        snapshot = self.snapshot()
+        if self.format == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(to_prometheus(snapshot))
+        os.replace(tmp_path, self.path)
+
+    def _write_loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                continue
+        try:
+            self.write()
+        except OSError:
+            pass
+
+
+def to_prometheus(snapshot):
+    lines = ["# TYPE caries_stage_latency_ms gauge"]
+    for stage, entry in snapshot["stages"].items():
+        for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+            lines.append(f'caries_stage_latency_ms{{stage="{stage}",quantile="{quantile}"}} {entry[key]}')
+    lines += [
+        "# TYPE caries_fps gauge",
+        f"caries_fps {snapshot['fps']}",
+        "# TYPE caries_frames_shown_total counter",
+        f"caries_frames_shown_total {snapshot['frames_shown']}",
+    ]
+    if snapshot["rss_bytes"] is not None:
+        lines += ["# TYPE caries_process_rss_bytes gauge", f"caries_process_rss_bytes {snapshot['rss_bytes']}"]
+    for key, value in snapshot["gauges"].items():
+        lines += [f"# TYPE caries_{key} gauge", f"caries_{key} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def format_overlay(snapshot):
+    lines = [f"FPS {snapshot['fps']:.1f}"]
+    for stage, entry in snapshot["stages"].items():
+        lines.append(f"{stage:<11} {entry['p50_ms']:7.1f} / {entry['p95_ms']:7.1f} ms")
+    for key, value in snapshot["gauges"].items():
+        lines.append(f"{key} {value}")
+    if snapshot["rss_bytes"] is not None:
+        lines.append(f"RSS {snapshot['rss_bytes'] / 2 ** 20:.0f} MB")
+    return "\n".join(lines)
+
+
+perf = PerfMetrics()
@@ -0,0 +1,377 @@
+import os
+import queue
+import threading
+import time
+
+import cv2
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtGui import QImage
+
+from perfmetrics import perf
+from render import FrameRenderer
+from tracker import LesionTracker
+from videoanalysis import analyze_video
+
+QUEUE_SIZE = 4
+# "realtime" plays files at their own frame rate and skips the frames inference
+# cannot keep up with; "exhaustive" analyzes every frame as fast as it can
+PLAYBACK_MODE = os.environ.get("CARIES_PLAYBACK_MODE", "realtime")
+PLAYBACK_MODES = ("realtime", "exhaustive")
+# Used when the container reports no frame rate, or a nonsense one
+DEFAULT_FPS = 30.0
+MAX_FPS = 240.0
+# Weight of the newest frame in the running average of processing time
+COST_SMOOTHING = 0.2
+# Seconds behind past which a realtime catch-up seeks instead of grabbing frames
+MAX_GRAB_SECONDS = 2.0
+
+_END = object()
+
+
+class FrameScheduler:
+    # Decides, before each read, how many frames to skip and how long to wait so the
+    # frame being read is shown when the source clock says it is due. The clock is
+    # anchored at the first frame after a start, seek or pause; cost is the running
+    # average of the time a frame spends in inference.
+    def __init__(self, fps, mode=PLAYBACK_MODE):
+        if mode not in PLAYBACK_MODES:
+            raise ValueError(f"Unknown playback mode '{mode}'")
+        self.fps = fps if fps and 0 < fps <= MAX_FPS else DEFAULT_FPS
+        self.mode = mode
+        self.cost = 0.0
+        self.anchor = None
+
+    def restart(self):
+        self.anchor = None
+
+    def record_cost(self, seconds):
+        self.cost = seconds if not self.cost else self.cost + COST_SMOOTHING * (seconds - self.cost)
+
+    def plan(self, frame_index):
+        # Returns (frames to skip, seconds to wait) before frame_index is read
+        if self.mode == "exhaustive":
+            return 0, 0.0
+        now = time.perf_counter()
+        if self.anchor is None:
+            self.anchor = (now, frame_index)
+            return 0, 0.0
+        anchor_time, anchor_index = self.anchor
+        # The frame that will be due once this one has been through inference
+        due_index = int(anchor_index + (now + self.cost - anchor_time) * self.fps)
+        if due_index > frame_index:
+            return due_index - frame_index, 0.0
+        due_time = anchor_time + (frame_index - anchor_index) / self.fps
+        return 0, max(due_time - self.cost - now, 0.0)
+
+
+class FramePipeline(QObject):
+    # Capture -> inference -> annotate, each stage on its own thread and joined by
+    # bounded queues. Live sources keep only the newest frame in every queue so the
+    # preview never lags behind the camera. File sources block on full queues and are
+    # paced by a FrameScheduler; in realtime mode the capture thread only reads once
+    # inference has taken the previous frame, so it never reads a frame that will
+    # already be stale when its turn comes.
+    frame_ready = Signal(QImage, int, object)
+    finished = Signal()
+    failed = Signal(str)
+
+    def __init__(self, cap, model, live, store, display_size, mode=PLAYBACK_MODE):
+        super().__init__()
+        self.cap = cap
+        self.model = model
+        self.live = live
+        self.store = store
+        self.renderer = FrameRenderer(*display_size, store.names)
+        # The QImages share the renderer's buffers, so a buffer is only drawn into
+        # again once the page has shown the frame it holds (see frame_shown)
+        self.free_buffers = threading.Semaphore(len(self.renderer.buffers) - 1)
+        self.tracker = LesionTracker(next_id=store.next_track_id())
+        self.scheduler = FrameScheduler(cap.get(cv2.CAP_PROP_FPS), mode)
+        self.paced = not live and mode == "realtime"
+        size = 1 if live or self.paced else QUEUE_SIZE
+        self.frame_queue = queue.Queue(maxsize=size)
+        self.result_queue = queue.Queue(maxsize=1 if live else QUEUE_SIZE)
+        self.inference_idle = threading.Event()
+        self.inference_idle.set()
+        self.stop_event = threading.Event()
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.lock = threading.Lock()
+        self.seek_seconds = 0.0
+        self.frame_sink = None
+        self.dropped_frames = 0
+        self.skipped_frames = 0
+        self.analyzed_frames = 0
+        self.detected_frames = 0
+        self.threads = []
+
+    def start(self):
+        for target, name in [(self._capture_loop, "capture"),
+                             (self._inference_loop, "inference"),
+                             (self._annotate_loop, "annotate")]:
+            thread = threading.Thread(target=target, name=f"pipeline-{name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        self.resume_event.set()
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+
+    def pause(self):
+        self.resume_event.clear()
+
+    def resume(self):
+        self.resume_event.set()
+
+    def seek(self, seconds):
+        with self.lock:
+            self.seek_seconds += seconds
+
+    def stats(self):
+        return {
+            "dropped_frames": self.dropped_frames,
+            "skipped_frames": self.skipped_frames,
+            "analyzed_frames": self.analyzed_frames,
+            "detected_frames": self.detected_frames,
+            "frame_queue": self.frame_queue.qsize(),
+            "result_queue": self.result_queue.qsize(),
+        }
+
+    def frame_shown(self):
+        # Called by the receiver of frame_ready once it no longer needs the QImage
+        self.free_buffers.release()
+
+    def set_frame_sink(self, sink):
+        # The sink is called from the annotate thread; holding the lock here means
+        # the caller can release a writer as soon as this returns.
+        with self.lock:
+            self.frame_sink = sink
+
+    def _put(self, q, item, drop=True):
+        if self.live and drop:
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                try:
+                    dropped = q.get_nowait()
+                    self.dropped_frames += 1
+                    if q is self.frame_queue:
+                        # Never reached inference
+                        self.skipped_frames += 1
+                        self.store.mark_skipped(dropped[0])
+                except queue.Empty:
+                    pass
+                q.put_nowait(item)
+            return True
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _apply_seek(self):
+        with self.lock:
+            seconds, self.seek_seconds = self.seek_seconds, 0.0
+        if not seconds:
+            return
+        fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        current_frame = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        target_frame = max(current_frame + int(fps * seconds), 0)
+        frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count > 0:
+            target_frame = min(target_frame, frame_count - 1)
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+        self.scheduler.restart()
+        # Frames already queued are from before the seek
+        dropped = []
+        while True:
+            try:
+                item = self.frame_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _END:
+                dropped.append(item[0])
+        if target_frame > current_frame:
+            # Jumped over, so never analyzed; a rewind plays the dropped frames again
+            self.skipped_frames += target_frame - current_frame + len(dropped)
+            self.store.mark_skipped(current_frame, target_frame)
+            for frame_index in dropped:
+                self.store.mark_skipped(frame_index)
+        self.inference_idle.set()
+
+    def _skip(self, frame_index, count):
+        # Grabbing does not convert the frame, so a short catch-up stays cheap; a long
+        # one is a single seek
+        if count > self.scheduler.fps * MAX_GRAB_SECONDS:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index + count)
+        else:
+            for _ in range(count):
+                if not self.cap.grab():
+                    break
+        skipped_to = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        self.skipped_frames += skipped_to - frame_index
+        self.store.mark_skipped(frame_index, skipped_to)
+        return skipped_to
+
+    def _fail(self, error):
+        # A backend error (e.g. the inference server went away) ends playback:
+        # capture and annotate stop with the inference thread and the page is told why
+        self.stop_event.set()
+        self.resume_event.set()
+        self.failed.emit(str(error))
+
+    def _wait_for_buffer(self):
+        while not self.stop_event.is_set():
+            if self.free_buffers.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _wait_for_inference(self):
+        while not self.stop_event.is_set():
+            if self.inference_idle.wait(timeout=0.1):
+                self.inference_idle.clear()
+                return True
+        return False
+
+    def _capture_loop(self):
+        frame_index = 0
+        while not self.stop_event.is_set():
+            if not self.resume_event.is_set():
+                if self.resume_event.wait(timeout=0.1):
+                    # Playback continues from here, not from where the clock was
+                    self.scheduler.restart()
+                continue
+            if self.paced and not self._wait_for_inference():
+                return
+            started = time.perf_counter()
+            self._apply_seek()
+            if not self.live:
+                frame_index = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+                skip, delay = self.scheduler.plan(frame_index)
+                if skip:
+                    frame_index = self._skip(frame_index, skip)
+                elif delay:
+                    time.sleep(delay)
+                started = time.perf_counter()
+            ret, frame = self.cap.read()
+            if not ret:
+                self._put(self.frame_queue, _END, drop=False)
+                return
+            if perf.enabled:
+                perf.record("capture", (time.perf_counter() - started) * 1000)
+                perf.mark_captured(frame_index)
+            if not self._put(self.frame_queue, (frame_index, frame)):
+                return
+            frame_index += 1
+
+    def _inference_loop(self):
+        while True:
+            item = self._get(self.frame_queue)
+            if item is _END:
+                self._put(self.result_queue, _END, drop=False)
+                return
+            frame_index, frame = item
+            started = time.perf_counter()
+            # Frames seen before a rewind are redrawn from the store, not re-detected
+            detections = self.store.frame_detections(frame_index)
+            if detections is None:
+                detected = self.tracker.needs_detection(frame_index, frame)
+                if detected:
+                    try:
+                        predicted = self.model.predict([frame])[0]
+                    except Exception as e:
+                        self._fail(e)
+                        return
+                    detections = self.tracker.update(frame_index, frame, predicted)
+                    self.detected_frames += 1
+                else:
+                    detections = self.tracker.propagate(frame_index, frame)
+                if perf.enabled:
+                    perf.record("inference" if detected else "tracking", (time.perf_counter() - started) * 1000)
+                if self.store.add(frame_index, detections, detected):
+                    self.analyzed_frames += 1
+            self.scheduler.record_cost(time.perf_counter() - started)
+            self.inference_idle.set()
+            if not self._put(self.result_queue, (frame_index, frame, detections)):
+                return
+
+    def _annotate_loop(self):
+        while True:
+            item = self._get(self.result_queue)
+            if item is _END:
+                if not self.stop_event.is_set():
+                    self.finished.emit()
+                return
+            frame_index, frame, detections = item
+            if not self._wait_for_buffer():
+                return
+            q_img = self.renderer.render(frame, detections)
+            with self.lock:
+                if self.frame_sink is not None:
+                    # Recordings keep the source resolution
+                    started = time.perf_counter()
+                    self.frame_sink(frame, detections)
+                    if perf.enabled:
+                        perf.record("record", (time.perf_counter() - started) * 1000)
+            if perf.enabled:
+                perf.record("render", self.renderer.last_render_ms)
+            self.frame_ready.emit(q_img, frame_index, detections)
+
+
+class VideoAnalysisWorker(QObject):
+    # Offline "analyze only" run of a video file on a background thread
+    progress = Signal(int, int, float)
+    finished = Signal()
+    failed = Signal(str)
+
+    def __init__(self, path, model, store, target_fps=None, cache=None):
+        super().__init__()
+        self.path = path
+        self.model = model
+        self.store = store
+        self.target_fps = target_fps
+        self.cache = cache
+        self.cancel_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="video-analysis", daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def _run(self):
+        try:
+            key = None
+            if self.cache:
+                key = self.cache.key(self.path, source="video", target_fps=self.target_fps,
+                                     **getattr(self.model, "cache_params", {}))
+                if self.cache.get(key, self.store):
+                    self.finished.emit()
+                    return
+            analyze_video(self.path, self.model, self.store, target_fps=self.target_fps,
+                          progress=self.progress.emit, cancel=self.cancel_event)
+            if key and not self.cancel_event.is_set():
+                self.cache.put(key, self.store)
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            if not self.cancel_event.is_set():
+                self.finished.emit()
@@ -0,0 +1,125 @@
+import os
+import queue
+import threading
+
+import cv2
+
+from render import draw_detections
+
+# "annotated", "raw" or both, comma separated
+RECORD_STREAMS = os.environ.get("CARIES_RECORD_STREAMS", "annotated").split(",")
+# "drop": a full queue discards the new frame so the preview never waits on the disk.
+# "block": a full queue holds up the pipeline so the recording is complete.
+RECORD_POLICY = os.environ.get("CARIES_RECORD_POLICY", "drop")
+RECORD_QUEUE_SIZE = int(os.environ.get("CARIES_RECORD_QUEUE_SIZE", 64))
+
+STREAM_FILES = {
+    "annotated": "camera_record.mp4",
+    "raw": "camera_record_raw.mp4",
+}
+
+_END = object()
+
+
+class AsyncVideoWriter:
+    # cv2.VideoWriter fed from a bounded queue on its own thread
+    def __init__(self, path, fps, size, policy=RECORD_POLICY, queue_size=RECORD_QUEUE_SIZE):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown recording policy '{policy}'")
+        self.path = path
+        self.policy = policy
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+        self.thread.start()
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def write(self, frame):
+        # A frame arriving after release() is ignored; nothing would drain the queue
+        with self.lock:
+            if self.closed:
+                return
+            if self.policy == "block":
+                self.queue.put(frame)
+            else:
+                try:
+                    self.queue.put_nowait(frame)
+                except queue.Full:
+                    self.dropped += 1
+                    return
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is _END:
+                return
+            self.writer.write(frame)
+            self.written += 1
+
+    def release(self):
+        # Frames already queued are still written before the file is closed
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(_END)
+        self.thread.join()
+        self.writer.release()
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class Recorder:
+    # One AsyncVideoWriter per requested stream; used as the pipeline's frame sink
+    def __init__(self, folder, fps, size, names, streams=RECORD_STREAMS, policy=RECORD_POLICY,
+                 queue_size=RECORD_QUEUE_SIZE):
+        unknown = set(streams) - set(STREAM_FILES)
+        if unknown:
+            raise ValueError(f"Unknown recording streams {sorted(unknown)}")
+        self.names = names
+        self.writers = {
+            stream: AsyncVideoWriter(os.path.join(folder, STREAM_FILES[stream]), fps, size, policy, queue_size)
+            for stream in streams
+        }
+
+    @property
+    def paths(self):
+        return [writer.path for writer in self.writers.values()]
+
+    def write(self, frame, detections):
+        raw = self.writers.get("raw")
+        annotated = self.writers.get("annotated")
+        if raw:
+            raw.write(frame.copy() if annotated else frame)
+        if annotated:
+            annotated.write(draw_detections(frame, detections, self.names))
+
+    def release(self):
+        for writer in self.writers.values():
+            writer.release()
+
+    def stats(self):
+        return {stream: writer.stats() for stream, writer in self.writers.items()}
+
+    def totals(self):
+        writers = self.writers.values()
+        return {
+            "written": sum(writer.written for writer in writers),
+            "dropped": sum(writer.dropped for writer in writers),
+            "queue_depth": max((writer.queue_depth for writer in writers), default=0),
+        }
@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+from PySide6.QtGui import QImage
+
+from detectionstore import Detections
+
+# BGR, one colour per caries class
+CLASS_COLORS = {
+    "Healthy": (80, 175, 76),
+    "Initial": (59, 235, 255),
+    "Moderate": (0, 152, 255),
+    "Extensive": (54, 67, 244),
+}
+DEFAULT_COLOR = (255, 255, 255)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def draw_detections(img, detections, names):
+    # Draws boxes in place from detection arrays, so a frame can be annotated
+    # without an ultralytics Results object (e.g. from cached detections)
+    line_width = max(round(sum(img.shape[:2]) / 2 * 0.003), 2)
+    font_scale = line_width / 3
+    tracks = detections.track if detections.track is not None else [-1] * len(detections.conf)
+    for box, conf, cls, track in zip(detections.xyxy, detections.conf, detections.cls, tracks):
+        label = names.get(int(cls), str(cls))
+        color = CLASS_COLORS.get(label, DEFAULT_COLOR)
+        x1, y1, x2, y2 = (int(v) for v in box)
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, line_width, cv2.LINE_AA)
+        text = f"{label} #{track} {conf:.2f}" if track >= 0 else f"{label} {conf:.2f}"
+        (text_width, text_height), baseline = cv2.getTextSize(text, FONT, font_scale, max(line_width - 1, 1))
+        label_top = y1 - text_height - baseline
+        if label_top < 0:
+            # No room above the box, put the label just inside it
+            label_top = y1
+        label_bottom = label_top + text_height + baseline
+        cv2.rectangle(img, (x1, label_top), (x1 + text_width, label_bottom), color, -1, cv2.LINE_AA)
+        cv2.putText(img, text, (x1, label_bottom - baseline), FONT, font_scale, (0, 0, 0),
+                    max(line_width - 1, 1), cv2.LINE_AA)
+    return img
+
+
+class FrameRenderer:
+    # Builds the preview image at display size: one resize straight into a reused
+    # buffer, boxes scaled and drawn onto that, and a BGR888 QImage wrapping the
+    # buffer so no colour conversion or extra copy is needed. Buffers rotate so a
+    # QImage still waiting in the signal queue is not overwritten by the next frame.
+    def __init__(self, width, height, names, buffers=4):
+        self.width = width
+        self.height = height
+        self.names = names
+        self.buffers = [np.empty((height, width, 3), np.uint8) for _ in range(buffers)]
+        self.next_buffer = 0
+        self.last_render_ms = 0.0
+
+    def render(self, frame, detections):
+        started = time.perf_counter()
+        buffer = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        frame_height, frame_width = frame.shape[:2]
+        # Bilinear rather than INTER_AREA: an order of magnitude cheaper at 1080p, and
+        # still smoother than the fast scaling QLabel used to apply
+        cv2.resize(frame, (self.width, self.height), dst=buffer, interpolation=cv2.INTER_LINEAR)
+        scale = np.array([self.width / frame_width, self.height / frame_height] * 2, np.float32)
+        draw_detections(buffer, detections._replace(xyxy=detections.xyxy * scale), self.names)
+        q_img = QImage(buffer.data, self.width, self.height, 3 * self.width, QImage.Format_BGR888)
+        self.last_render_ms = (time.perf_counter() - started) * 1000
+        return q_img
+
+
+def legacy_render(frame, detections, names):
+    # The previous path: annotate at source resolution, convert to RGB and copy into a
+    # QImage, leaving the downscale to the label. Kept for comparison only.
+    img = draw_detections(frame.copy(), detections, names)
+    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    height, width, channel = img_rgb.shape
+    q_img = QImage(img_rgb.data, width, height, 3 * width, QImage.Format_RGB888).copy()
+    return q_img.scaled(600, 400)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-frame render time of the old and new preview paths.")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--boxes", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (args.height, args.width, 3), np.uint8)
+    corners = rng.uniform(0, 0.8, (args.boxes, 2)) * [args.width, args.height]
+    sizes = rng.uniform(0.05, 0.2, (args.boxes, 2)) * [args.width, args.height]
+    detections = Detections(np.hstack([corners, corners + sizes]).astype(np.float32),
+                            rng.uniform(0.3, 1, args.boxes).astype(np.float32),
+                            rng.integers(0, 4, args.boxes).astype(np.int16))
+    names = {0: "Healthy", 1: "Initial", 2: "Moderate", 3: "Extensive"}
+    renderer = FrameRenderer(600, 400, names)
+    for label, render in [("legacy", lambda: legacy_render(frame, detections, names)),
+                          ("display-size", lambda: renderer.render(frame, detections))]:
+        timings = []
+        for _ in range(args.frames):
+            started = time.perf_counter()
+            render()
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{label}: median {np.median(timings):.2f} ms, p95 {np.percentile(timings, 95):.2f} ms per frame")
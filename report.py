@@ -0,0 +1,168 @@
+import argparse
+import io
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from detectionstore import CLASSES
+from patientstore import PATIENT_STORE, open_patient_store
+
+REPORT_DIR = os.environ.get("CARIES_REPORT_DIR", "reports")
+REPORT_DPI = 150
+REPORT_FORMATS = ("png", "pdf")
+# Reports handed to a pool worker at a time
+REPORT_CHUNK = 16
+# A4 portrait, in inches
+PAGE_SIZE = (8.27, 11.69)
+
+_local = threading.local()
+
+
+def draw_pie(ax, counts):
+    total = sum(counts.get(cls, 0) for cls in CLASSES)
+    if not total:
+        ax.text(0.5, 0.5, "No caries detected", ha="center", va="center", fontsize=14)
+        ax.set_axis_off()
+    else:
+        sizes = [counts.get(cls, 0) for cls in CLASSES]
+        labels = [f"{cls} ({counts.get(cls, 0) / total * 100:.1f}%)" for cls in CLASSES]
+        ax.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=140)
+    ax.set_title("Caries Class Distribution")
+
+
+def summary_details(summary):
+    if summary["mode"] in (None, "image"):
+        return []
+    return [f"Source: {summary['mode']}", f"Frames analyzed: {summary['frames']}"]
+
+
+class ReportRenderer:
+    # Draws reports on one Agg figure that is cleared and reused, so no GUI, no
+    # pyplot state and no new Figure per report. Not thread-safe: use one per
+    # thread or process, which renderer() takes care of.
+    def __init__(self, dpi=REPORT_DPI):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.dpi = dpi
+        self.figure = Figure(figsize=PAGE_SIZE)
+        FigureCanvasAgg(self.figure)
+        self.chart = Figure(figsize=(4, 4))
+        FigureCanvasAgg(self.chart)
+
+    def chart_png(self, counts):
+        # The pie on its own, for the result page
+        self.chart.clear()
+        draw_pie(self.chart.add_subplot(111), counts)
+        buffer = io.BytesIO()
+        self.chart.savefig(buffer, format="png", dpi=100)
+        return buffer.getvalue()
+
+    def render(self, paths, patient_data, counts, mode=None, details=()):
+        # Writes the same page to every path; the format follows the extension
+        fig = self.figure
+        fig.clear()
+        fig.suptitle("Caries Analysis Results", fontsize=18, fontweight="bold")
+        draw_pie(fig.add_axes([0.15, 0.5, 0.7, 0.4]), counts)
+
+        total = sum(counts.get(cls, 0) for cls in CLASSES) or 1
+        table_ax = fig.add_axes([0.05, 0.1, 0.5, 0.3])
+        table_ax.set_axis_off()
+        table = table_ax.table(
+            cellText=[[cls, str(counts.get(cls, 0)), f"{counts.get(cls, 0) / total * 100:.2f}"] for cls in CLASSES],
+            colLabels=["Class", "Quantity" if mode in (None, "image") else "Lesions", "Percentage (%)"],
+            loc="upper center",
+        )
+        table.scale(1, 1.6)
+
+        lines = [f"{key}: {'' if value is None else value}" for key, value in patient_data.items()]
+        text_ax = fig.add_axes([0.6, 0.1, 0.35, 0.3])
+        text_ax.set_axis_off()
+        text_ax.text(0, 1, "\n".join(lines + list(details)), va="top", fontsize=9, wrap=True)
+        fig.text(0.05, 0.03, f"Generated {time.strftime('%Y-%m-%d %H:%M')}", fontsize=7, color="grey")
+        for path in paths:
+            fig.savefig(path, dpi=self.dpi)
+        return paths
+
+
+def renderer():
+    # This thread's (or pool process's) renderer, created on first use
+    if getattr(_local, "renderer", None) is None:
+        _local.renderer = ReportRenderer()
+    return _local.renderer
+
+
+def render_report(paths, patient_data, counts, mode=None, details=()):
+    return renderer().render(paths, patient_data, counts, mode, details)
+
+
+def render_chart(counts):
+    return renderer().chart_png(counts)
+
+
+def report_filename(visit_id, patient_data, fmt):
+    name = re.sub(r"[^\w-]+", "_", str(patient_data.get("Name") or "patient")).strip("_")
+    return f"{patient_data.get('Date') or 'undated'}_{visit_id}_{name}.{fmt}"
+
+
+def _render_job(job):
+    path, patient_data, summary = job
+    render_report([path], patient_data, summary["counts"], summary["mode"], summary_details(summary))
+    return path
+
+
+def export_reports(store, directory=REPORT_DIR, date_from=None, date_to=None, fmt="pdf", workers=None):
+    # One report per visit with a saved analysis; rendering runs in a process pool
+    # while this process reads the next visits. Returns (written, skipped).
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format '{fmt}'")
+    os.makedirs(directory, exist_ok=True)
+    skipped = 0
+
+    def jobs():
+        nonlocal skipped
+        for chunk in store.iter_visits(date_from, date_to):
+            for visit_id, patient_data, counts in chunk:
+                summary = store.latest_summary(visit_id) if counts is not None else None
+                if summary is None:
+                    skipped += 1
+                    continue
+                yield os.path.join(directory, report_filename(visit_id, patient_data, fmt)), patient_data, summary
+
+    written = 0
+    with ProcessPoolExecutor(workers) as pool:
+        for _ in pool.map(_render_job, jobs(), chunksize=REPORT_CHUNK):
+            written += 1
+    return written, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render analysis reports from saved detection summaries.")
+    parser.add_argument("--store", help=f"Existing patient store (default: {PATIENT_STORE})")
+    parser.add_argument("--from", dest="date_from")
+    parser.add_argument("--to", dest="date_to")
+    parser.add_argument("--visit", type=int, help="Render only this visit")
+    parser.add_argument("--format", choices=REPORT_FORMATS, default="pdf")
+    parser.add_argument("--output", default=REPORT_DIR, help="Output folder")
+    parser.add_argument("--workers", type=int, help="Rendering processes (default: one per CPU)")
+    args = parser.parse_args()
+    try:
+        patient_store = open_patient_store(args.store)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    if args.visit is not None:
+        patient_data, summary = patient_store.visit(args.visit), patient_store.latest_summary(args.visit)
+        if patient_data is None or summary is None:
+            raise SystemExit(f"Visit {args.visit} has no saved analysis")
+        os.makedirs(args.output, exist_ok=True)
+        path = _render_job((os.path.join(args.output, report_filename(args.visit, patient_data, args.format)),
+                            patient_data, summary))
+        print(f"Report written to {path}")
+    else:
+        started = time.perf_counter()
+        written, skipped = export_reports(patient_store, args.output, args.date_from, args.date_to, args.format,
+                                          args.workers)
+        print(f"Wrote {written} reports to {args.output} in {time.perf_counter() - started:.1f}s "
+              f"({skipped} visits without a saved analysis)")
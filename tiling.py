@@ -0,0 +1,235 @@
+import argparse
+import json
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+
+from backends import IMGSZ, nms
+from detectionstore import Detections, box_iou, empty_detections
+
+# Sources ("image", "video", "camera") that start with ROI + tiled inference on; none
+# until tiling.py has shown better recall on the clinic's own photos
+TILED_MODES = [m for m in os.environ.get("CARIES_TILED_MODES", "").split(",") if m]
+TILE_OVERLAP = float(os.environ.get("CARIES_TILE_OVERLAP", 0.2))
+MAX_TILES = int(os.environ.get("CARIES_MAX_TILES", 6))
+# Frames between ROI searches in a video
+ROI_REFRESH = 30
+ROI_THUMB_WIDTH = 256
+ROI_MARGIN = 0.1
+# Below this share of the frame the mask is not trusted and the whole frame is used
+ROI_MIN_AREA = 0.02
+# Boxes mostly inside a stronger box of the same class are the same lesion cut by a tile edge
+MERGE_IOU = 0.5
+MERGE_IOS = 0.7
+
+
+def find_roi(frame):
+    # Teeth are the bright, unsaturated part of an intraoral image; lips, gums and
+    # background are darker or redder. Returns (x1, y1, x2, y2) in frame pixels.
+    height, width = frame.shape[:2]
+    scale = ROI_THUMB_WIDTH / width
+    # Striding first keeps INTER_AREA from reading every pixel of a 12 MP photo
+    step = max(1, width // (2 * ROI_THUMB_WIDTH))
+    thumb = cv2.resize(frame[::step, ::step], (ROI_THUMB_WIDTH, max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(thumb, cv2.COLOR_BGR2HSV)
+    mask = ((hsv[:, :, 1] < 80) & (hsv[:, :, 2] > 120)).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((7, 7), np.uint8))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+    keep = [i for i in range(1, count) if stats[i, cv2.CC_STAT_AREA] >= mask.size * 0.005]
+    if not keep or sum(stats[i, cv2.CC_STAT_AREA] for i in keep) < mask.size * ROI_MIN_AREA:
+        return 0, 0, width, height
+    x1 = min(stats[i, cv2.CC_STAT_LEFT] for i in keep)
+    y1 = min(stats[i, cv2.CC_STAT_TOP] for i in keep)
+    x2 = max(stats[i, cv2.CC_STAT_LEFT] + stats[i, cv2.CC_STAT_WIDTH] for i in keep)
+    y2 = max(stats[i, cv2.CC_STAT_TOP] + stats[i, cv2.CC_STAT_HEIGHT] for i in keep)
+    margin_x, margin_y = (x2 - x1) * ROI_MARGIN, (y2 - y1) * ROI_MARGIN
+    return (max(0, int((x1 - margin_x) / scale)), max(0, int((y1 - margin_y) / scale)),
+            min(width, math.ceil((x2 + margin_x) / scale)), min(height, math.ceil((y2 + margin_y) / scale)))
+
+
+def tile_grid(roi, tile=IMGSZ, overlap=TILE_OVERLAP, max_tiles=MAX_TILES):
+    # Square tiles of at least the model input size covering the ROI with the
+    # requested overlap; tiles grow until at most max_tiles are needed
+    x1, y1, x2, y2 = roi
+    width, height = x2 - x1, y2 - y1
+
+    def counts(size):
+        step = size * (1 - overlap)
+        return max(1, math.ceil((width - size) / step) + 1), max(1, math.ceil((height - size) / step) + 1)
+
+    size = tile
+    while counts(size)[0] * counts(size)[1] > max_tiles:
+        size = int(size * 1.25)
+    cols, rows = counts(size)
+    tile_width, tile_height = min(size, width), min(size, height)
+    xs = np.linspace(x1, x2 - tile_width, cols).round().astype(int) if cols > 1 else [x1]
+    ys = np.linspace(y1, y2 - tile_height, rows).round().astype(int) if rows > 1 else [y1]
+    return [(int(x), int(y), int(x) + tile_width, int(y) + tile_height) for y in ys for x in xs]
+
+
+def merge_tiles(xyxy, conf, cls, iou=MERGE_IOU, ios=MERGE_IOS):
+    # Cross-tile NMS, plus suppression of a box that lies mostly inside a stronger
+    # box of the same class, which plain IoU misses for lesions cut by a tile edge
+    if not len(conf):
+        return np.zeros(0, np.int64)
+    keep = nms(xyxy, conf, cls, iou)
+    xyxy, cls = xyxy[keep], cls[keep]
+    top_left = np.maximum(xyxy[:, None, :2], xyxy[None, :, :2])
+    bottom_right = np.minimum(xyxy[:, None, 2:], xyxy[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area = np.prod(xyxy[:, 2:] - xyxy[:, :2], axis=1)
+    inside = intersection / np.maximum(area[:, None], 1e-9)
+    suppressed = np.zeros(len(keep), bool)
+    # keep is ordered by confidence, so only stronger boxes (lower index) suppress
+    for i in range(1, len(keep)):
+        stronger = ~suppressed[:i] & (cls[:i] == cls[i])
+        if (inside[i, :i][stronger] > ios).any():
+            suppressed[i] = True
+    return keep[~suppressed]
+
+
+class TiledDetector:
+    # Drop-in for ModelManager.predict: finds the dentition ROI, cuts it into
+    # overlapping tiles and runs every tile of every image through the model in one
+    # call. In a video the ROI is kept for ROI_REFRESH frames, so the colour search
+    # runs once a second rather than per frame. One instance per video or camera.
+    def __init__(self, model, tile=IMGSZ, overlap=TILE_OVERLAP, max_tiles=MAX_TILES, roi_refresh=ROI_REFRESH):
+        self.model = model
+        self.tile = tile
+        self.overlap = overlap
+        self.max_tiles = max_tiles
+        self.roi_refresh = roi_refresh
+        self.roi = None
+        self.roi_age = 0
+        self.last_tiles = []
+
+    @property
+    def names(self):
+        return self.model.names
+
+    @property
+    def cache_params(self):
+        # Added to inference cache keys so tiled and whole-frame results stay apart
+        return {"tiled": True, "overlap": self.overlap, "max_tiles": self.max_tiles, "tile": self.tile}
+
+    @property
+    def source_size(self):
+        # Longest image side worth decoding: beyond a roughly square grid of max_tiles
+        # model-sized tiles, the extra pixels are scaled away again
+        cols = math.ceil(math.sqrt(self.max_tiles))
+        return int(self.tile * (1 + (1 - self.overlap) * (cols - 1)))
+
+    def _roi(self, frame):
+        if self.roi is None or self.roi_age >= self.roi_refresh or self.roi[2] > frame.shape[1] \
+                or self.roi[3] > frame.shape[0]:
+            self.roi = find_roi(frame)
+            self.roi_age = 0
+        self.roi_age += 1
+        return self.roi
+
+    def predict(self, images, **kwargs):
+        crops, owners, offsets = [], [], []
+        for i, img in enumerate(images):
+            tiles = tile_grid(self._roi(img), self.tile, self.overlap, self.max_tiles)
+            self.last_tiles = tiles
+            for x1, y1, x2, y2 in tiles:
+                crops.append(img[y1:y2, x1:x2])
+                owners.append(i)
+                offsets.append((x1, y1))
+        outputs = self.model.predict(crops, **kwargs) if crops else []
+        results = []
+        for i in range(len(images)):
+            parts = [(d, offsets[k]) for k, d in enumerate(outputs) if owners[k] == i and len(d.conf)]
+            if not parts:
+                results.append(empty_detections())
+                continue
+            xyxy = np.concatenate([d.xyxy + np.array(offset * 2, np.float32) for d, offset in parts])
+            conf = np.concatenate([d.conf for d, _ in parts])
+            cls = np.concatenate([d.cls for d, _ in parts])
+            keep = merge_tiles(xyxy, conf, cls)
+            results.append(Detections(xyxy[keep], conf[keep], cls[keep]))
+        return results
+
+
+def read_labels(path, width, height):
+    # YOLO txt labels -> xyxy pixels and class ids
+    rows = np.loadtxt(path, ndmin=2) if os.path.exists(path) and os.path.getsize(path) else np.zeros((0, 5))
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    return np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], 1).astype(np.float32), rows[:, 0].astype(int)
+
+
+def recall(truth, detections, threshold=0.5):
+    truth_xyxy, truth_cls = truth
+    if not len(truth_cls):
+        return 0, 0
+    if not len(detections.conf):
+        return 0, len(truth_cls)
+    iou = box_iou(truth_xyxy, detections.xyxy)
+    iou[truth_cls[:, None] != detections.cls[None, :]] = 0
+    return int((iou.max(1) >= threshold).sum()), len(truth_cls)
+
+
+def main(argv=None):
+    from exportmodel import agreement
+    from mediafiles import IMAGE_EXTENSIONS
+    from modelmanager import MODEL_PATH, ModelManager
+
+    parser = argparse.ArgumentParser(description="Compare ROI + tiled inference with whole-frame inference: "
+                                                 "latency, and recall against labels or the whole-frame boxes.")
+    parser.add_argument("images", help="Folder of images")
+    parser.add_argument("--labels", help="Folder of YOLO txt labels with the same file names")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--overlap", type=float, default=TILE_OVERLAP)
+    parser.add_argument("--max-tiles", type=int, default=MAX_TILES)
+    parser.add_argument("--report", default="tiling_report.json")
+    args = parser.parse_args(argv)
+
+    model = ModelManager(args.model)
+    if model.load() is None:
+        raise SystemExit(f"Failed to load {args.model}: {model.error}")
+    names, images = [], []
+    for name in sorted(os.listdir(args.images)):
+        img = cv2.imread(os.path.join(args.images, name)) if name.lower().endswith(IMAGE_EXTENSIONS) else None
+        if img is not None and len(images) < args.limit:
+            names.append(name)
+            images.append(img)
+    report = {"images": len(images), "modes": {}}
+    outputs = {}
+    for mode in ("whole", "tiled"):
+        detector = model if mode == "whole" else TiledDetector(model, overlap=args.overlap, max_tiles=args.max_tiles)
+        timings, results, found, total, tiles = [], [], 0, 0, 0
+        for name, img in zip(names, images):
+            if mode == "tiled":
+                # Every photo is a new scene
+                detector.roi = None
+            started = time.perf_counter()
+            detections = detector.predict([img])[0]
+            timings.append((time.perf_counter() - started) * 1000)
+            results.append(detections)
+            tiles += len(detector.last_tiles) if mode == "tiled" else 1
+            if args.labels:
+                label_path = os.path.join(args.labels, os.path.splitext(name)[0] + ".txt")
+                hit, count = recall(read_labels(label_path, img.shape[1], img.shape[0]), detections)
+                found += hit
+                total += count
+        outputs[mode] = results
+        entry = {"median_ms": round(float(np.median(timings)), 2), "p95_ms": round(float(np.percentile(timings, 95)), 2),
+                 "boxes": int(sum(len(d.conf) for d in results)), "tiles_per_image": round(tiles / max(len(images), 1), 2)}
+        if args.labels:
+            entry["recall"] = round(found / total, 4) if total else None
+        report["modes"][mode] = entry
+    report["modes"]["tiled"]["agreement_vs_whole"] = agreement(outputs["whole"], outputs["tiled"])
+    for mode, entry in report["modes"].items():
+        print(f"{mode:6s} " + " ".join(f"{key}={value}" for key, value in entry.items()))
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+
+import cv2
+import numpy as np
+
+from detectionstore import Detections, box_iou, empty_detections
+
+# The detector runs on every DETECT_EVERY-th frame, or sooner on a scene change;
+# frames in between get the previous boxes moved along by optical flow
+DETECT_EVERY = int(os.environ.get("CARIES_DETECT_EVERY", 5))
+# Mean absolute grey-level difference of a thumbnail that counts as a new scene
+SCENE_CHANGE = float(os.environ.get("CARIES_SCENE_CHANGE", 12.0))
+TRACK_IOU = 0.3
+# Detector runs a track may go unmatched before it is closed
+MAX_MISSES = 2
+# Across a larger jump (a seek, a long skip) flow is not trusted and tracks restart
+MAX_GAP = 60
+FLOW_WIDTH = 320
+THUMB_SIZE = (32, 18)
+# Flow points per side of the grid laid over each box
+FLOW_GRID = 4
+MIN_FLOW_POINTS = 3
+
+
+class Track:
+    __slots__ = ("id", "box", "conf", "cls", "misses")
+
+    def __init__(self, track_id, box, conf, cls):
+        self.id = track_id
+        self.box = box
+        self.conf = conf
+        self.cls = cls
+        self.misses = 0
+
+
+class LesionTracker:
+    # Gives every lesion a stable ID. Detector output is matched to the open tracks
+    # greedily by IoU after the tracks have been moved to the current frame by
+    # Lucas-Kanade flow on a small grey copy of the frame; detections left over
+    # start new tracks.
+    def __init__(self, detect_every=DETECT_EVERY, scene_change=SCENE_CHANGE, next_id=0):
+        self.detect_every = max(1, detect_every)
+        self.scene_change = scene_change
+        self.next_id = next_id
+        self.tracks = []
+        self.prev_gray = None
+        self.last_index = None
+        self.last_detection_index = None
+        self.detection_thumb = None
+        self.prepared = None
+
+    def _prepare(self, frame):
+        if self.prepared is not None and self.prepared[0] is frame:
+            return self.prepared[1:]
+        height, width = frame.shape[:2]
+        scale = FLOW_WIDTH / width
+        small = cv2.resize(frame, (FLOW_WIDTH, max(1, round(height * scale))), interpolation=cv2.INTER_LINEAR)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        self.prepared = (frame, gray, scale)
+        return gray, scale
+
+    def _continues(self, frame_index):
+        return self.last_index is not None and 0 < frame_index - self.last_index <= MAX_GAP
+
+    def needs_detection(self, frame_index, frame):
+        if self.last_detection_index is None or not self._continues(frame_index):
+            return True
+        if frame_index - self.last_detection_index >= self.detect_every:
+            return True
+        gray, _ = self._prepare(frame)
+        thumb = cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.absdiff(thumb, self.detection_thumb).mean() > self.scene_change
+
+    def _flow(self, gray, scale):
+        if not self.tracks or self.prev_gray is None:
+            return
+        steps = (np.arange(FLOW_GRID) + 0.5) / FLOW_GRID * 0.6 + 0.2
+        boxes = np.array([track.box for track in self.tracks], np.float32) * scale
+        xs = boxes[:, 0, None] + (boxes[:, 2] - boxes[:, 0])[:, None] * steps
+        ys = boxes[:, 1, None] + (boxes[:, 3] - boxes[:, 1])[:, None] * steps
+        points = np.stack(np.broadcast_arrays(xs[:, None, :], ys[:, :, None]), axis=-1).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points.astype(np.float32), None,
+                                                    winSize=(15, 15), maxLevel=2)
+        shifts = (moved - points).reshape(len(self.tracks), -1, 2)
+        good = status.reshape(len(self.tracks), -1).astype(bool)
+        height, width = gray.shape
+        for track, shift, ok in zip(self.tracks, shifts, good):
+            if ok.sum() < MIN_FLOW_POINTS:
+                continue
+            dx, dy = np.median(shift[ok], axis=0) / scale
+            box = track.box + np.array([dx, dy, dx, dy], np.float32)
+            track.box = np.clip(box, 0, [width / scale, height / scale] * 2).astype(np.float32)
+
+    def _advance(self, frame_index, gray, scale):
+        if self._continues(frame_index):
+            self._flow(gray, scale)
+        else:
+            self.tracks = []
+        self.prev_gray = gray
+        self.last_index = frame_index
+
+    def update(self, frame_index, frame, detections):
+        # Detector output for frame_index -> the same Detections with track IDs
+        gray, scale = self._prepare(frame)
+        self._advance(frame_index, gray, scale)
+        self.last_detection_index = frame_index
+        self.detection_thumb = cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+
+        ids = np.full(len(detections.conf), -1, np.int32)
+        matched = set()
+        if self.tracks and len(ids):
+            iou = box_iou(detections.xyxy, np.array([track.box for track in self.tracks], np.float32))
+            for flat in np.argsort(-iou, axis=None):
+                det, t = np.unravel_index(flat, iou.shape)
+                if iou[det, t] < TRACK_IOU:
+                    break
+                if ids[det] >= 0 or t in matched:
+                    continue
+                track = self.tracks[t]
+                track.box = detections.xyxy[det].copy()
+                track.conf = float(detections.conf[det])
+                track.cls = int(detections.cls[det])
+                track.misses = 0
+                ids[det] = track.id
+                matched.add(t)
+        for t, track in enumerate(self.tracks):
+            if t not in matched:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= MAX_MISSES]
+        for det in np.flatnonzero(ids < 0):
+            self.tracks.append(Track(self.next_id, detections.xyxy[det].copy(), float(detections.conf[det]),
+                                     int(detections.cls[det])))
+            ids[det] = self.next_id
+            self.next_id += 1
+        return detections._replace(track=ids)
+
+    def propagate(self, frame_index, frame):
+        # Boxes for a frame the detector did not see: the tracks it matched last time,
+        # moved by the flow since then
+        gray, scale = self._prepare(frame)
+        self._advance(frame_index, gray, scale)
+        visible = [track for track in self.tracks if track.misses == 0]
+        if not visible:
+            return empty_detections()._replace(track=np.zeros(0, np.int32))
+        return Detections(
+            np.array([track.box for track in visible], np.float32),
+            np.array([track.conf for track in visible], np.float32),
+            np.array([track.cls for track in visible], np.int16),
+            np.array([track.id for track in visible], np.int32),
+        )
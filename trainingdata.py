@@ -1,13 +1,350 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
 from ultralytics import YOLO
+from ultralytics.cfg import get_cfg
+from ultralytics.data import YOLODataset
+from ultralytics.data.utils import check_det_dataset, get_split_fraction
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import DEFAULT_CFG, colorstr
+from ultralytics.utils.torch_utils import unwrap_model
+
+# Dataset config (a data.yaml with train/val paths and class names)
+DATA_YAML = os.environ.get("CARIES_DATA", "data.yaml")
+BASE_MODEL = os.environ.get("CARIES_BASE_MODEL", "yolo11n.pt")
+# Empty picks the first GPU when there is one, else the CPU
+TRAIN_DEVICE = os.environ.get("CARIES_TRAIN_DEVICE", "")
+TRAIN_CACHE = os.environ.get("CARIES_TRAIN_CACHE", "train_cache")
+EPOCHS = 50
+BATCH = 16
+IMGSZ = 640
+SWEEP_MODELS = ["yolo11n.pt", "yolo11s.pt", "yolo11m.pt"]
+SWEEP_IMGSZ = [320, 480, 640]
+SWEEP_REPORT = "sweep_report.json"
+LATENCY_RUNS = 30
+CACHE_VERSION = 1
+
+
+def default_device():
+    import torch
+
+    return "0" if torch.cuda.is_available() else "cpu"
+
+
+def cache_dir_for(img_path, imgsz, root=TRAIN_CACHE):
+    key = hashlib.sha1(json.dumps([img_path, imgsz, CACHE_VERSION]).encode()).hexdigest()[:12]
+    return os.path.join(root, f"{key}_{imgsz}")
+
+
+def _fingerprint(files):
+    digest = hashlib.sha1()
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            digest.update(f"{path}:missing".encode())
+            continue
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def prepare_cache(img_path, imgsz, data, hyp=None, root=TRAIN_CACHE, workers=None):
+    # Decodes and resizes every image of a split once, exactly as YOLODataset.load_image
+    # would, into one uint8 file, and writes the labels into flat arrays next to it.
+    # Returns the cache folder; an up-to-date cache is left alone.
+    hyp = hyp or get_cfg(DEFAULT_CFG)
+    source = YOLODataset(img_path=img_path, imgsz=imgsz, augment=False, hyp=hyp, data=data, cache=None,
+                         prefix=colorstr("cache: "))
+    fingerprint = _fingerprint(source.im_files + source.label_files)
+    directory = cache_dir_for(img_path, imgsz, root)
+    meta_path = os.path.join(directory, "index.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["fingerprint"] == fingerprint and meta["version"] == CACHE_VERSION:
+            return directory
+
+    tmp_dir = f"{directory}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    count = len(source.im_files)
+    offsets = np.zeros(count + 1, np.int64)
+    shapes = np.zeros((count, 3), np.int32)
+    hw0 = np.zeros((count, 2), np.int32)
+    started = time.perf_counter()
+    # cv2 releases the GIL while decoding and resizing
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool, \
+            open(os.path.join(tmp_dir, "images.bin"), "wb") as f:
+        for i, (im, original, _) in enumerate(pool.map(source.load_image, range(count))):
+            im = np.ascontiguousarray(im)
+            f.write(im.data)
+            offsets[i + 1] = offsets[i] + im.nbytes
+            shapes[i] = im.shape
+            hw0[i] = original
+
+    labels = source.labels
+    label_offsets = np.cumsum([0] + [len(lb["cls"]) for lb in labels]).astype(np.int64)
+    np.savez(
+        os.path.join(tmp_dir, "index.npz"),
+        offsets=offsets, shapes=shapes, hw0=hw0, label_offsets=label_offsets,
+        cls=np.concatenate([lb["cls"].reshape(-1, 1) for lb in labels]).astype(np.float32),
+        bboxes=np.concatenate([lb["bboxes"].reshape(-1, 4) for lb in labels]).astype(np.float32),
+    )
+    with open(os.path.join(tmp_dir, "index.json"), "w") as f:
+        json.dump({
+            "version": CACHE_VERSION,
+            "fingerprint": fingerprint,
+            "imgsz": imgsz,
+            "im_files": source.im_files,
+            "normalized": labels[0]["normalized"] if labels else True,
+            "bbox_format": labels[0]["bbox_format"] if labels else "xywh",
+        }, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+    print(f"Cached {count} images ({offsets[-1] / 2 ** 20:.0f} MB) at imgsz {imgsz} in "
+          f"{time.perf_counter() - started:.1f}s -> {directory}")
+    return directory
+
+
+class MemmapYOLODataset(YOLODataset):
+    # YOLODataset over a prepare_cache folder: labels come from the index instead of
+    # the label files, and load_image returns views into the memory-mapped image
+    # file, so an epoch neither decodes nor copies. The map is copy-on-write, so an
+    # augmentation that writes into its input never touches the file.
+    def __init__(self, *args, cache_dir, **kwargs):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            self.cache_meta = json.load(f)
+        with np.load(os.path.join(cache_dir, "index.npz")) as index:
+            self.cache_index = {key: index[key] for key in index.files}
+        self.memmap = self._open_memmap()
+        super().__init__(*args, **kwargs)
+
+    def _open_memmap(self):
+        path = os.path.join(self.cache_dir, "images.bin")
+        if not os.path.getsize(path):
+            return np.zeros(0, np.uint8)
+        return np.memmap(path, np.uint8, mode="c")
+
+    def __getstate__(self):
+        # Dataloader workers started with spawn reopen the map rather than receive a copy
+        state = self.__dict__.copy()
+        state["memmap"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memmap = self._open_memmap()
+
+    def get_labels(self):
+        # Keeps get_img_files' selection (e.g. a fraction). Images are looked up by
+        # path, since rect mode reorders im_files afterwards.
+        wanted = set(self.im_files)
+        self.cache_slots = {path: slot for slot, path in enumerate(self.cache_meta["im_files"]) if path in wanted}
+        self.im_files = list(self.cache_slots)
+        self.label_files = []
+        index = self.cache_index
+        labels = []
+        for path, slot in self.cache_slots.items():
+            start, stop = index["label_offsets"][slot], index["label_offsets"][slot + 1]
+            labels.append({
+                "im_file": path,
+                "shape": tuple(int(v) for v in index["hw0"][slot]),
+                "cls": index["cls"][start:stop].copy(),
+                "bboxes": index["bboxes"][start:stop].copy(),
+                "segments": [],
+                "keypoints": None,
+                "normalized": self.cache_meta["normalized"],
+                "bbox_format": self.cache_meta["bbox_format"],
+            })
+        if not labels:
+            raise RuntimeError(f"No cached images for {self.img_path} in {self.cache_dir}")
+        return labels
+
+    def load_image(self, i, rect_mode=True, resize_short=False):
+        if not rect_mode or resize_short or self.imgsz != self.cache_meta["imgsz"]:
+            return super().load_image(i, rect_mode, resize_short)
+        slot = self.cache_slots[self.im_files[i]]
+        start = self.cache_index["offsets"][slot]
+        height, width, channels = self.cache_index["shapes"][slot]
+        im = self.memmap[start:start + height * width * channels].reshape(height, width, channels)
+        if self.augment:
+            # Mosaic picks its other images from the buffer
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return im, tuple(int(v) for v in self.cache_index["hw0"][slot]), (int(height), int(width))
+
+
+class CachedDetectionTrainer(DetectionTrainer):
+    # DetectionTrainer whose train and val datasets read from the memmap cache,
+    # building it first if needed
+    def build_dataset(self, img_path, mode="train", batch=None):
+        stride = max(int(unwrap_model(self.model).stride.max()), 32)
+        cache_dir = prepare_cache(img_path, self.args.imgsz, self.data, self.args, workers=self.args.workers or None)
+        fraction = 1.0 if self.data.get("complete") else get_split_fraction(
+            self.args.fraction, "train" if mode == "train" else self.args.split)
+        return MemmapYOLODataset(
+            cache_dir=cache_dir,
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode}: "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=fraction,
+        )
+
+
+def train(data=DATA_YAML, model=BASE_MODEL, epochs=EPOCHS, imgsz=IMGSZ, batch=BATCH, device=TRAIN_DEVICE, **kwargs):
+    # Returns (YOLO model, validation metrics) of the finished run
+    yolo = YOLO(model)
+    metrics = yolo.train(trainer=CachedDetectionTrainer, data=data, epochs=epochs, imgsz=imgsz, batch=batch,
+                         device=device or default_device(), **kwargs)
+    return yolo, metrics
+
+
+def _sweep_job(job):
+    import torch
+
+    model, imgsz, threads, options = job
+    torch.set_num_threads(threads)
+    name = f"{os.path.splitext(os.path.basename(model))[0]}_{imgsz}"
+    yolo, metrics = train(options["data"], model, options["epochs"], imgsz, options["batch"], device="cpu",
+                          workers=options["workers"], project=options["project"], name=name, exist_ok=True,
+                          plots=False, verbose=False)
+    results = metrics.results_dict
+    return {
+        "model": model,
+        "imgsz": imgsz,
+        "weights": str(yolo.trainer.best),
+        "map50": round(float(results["metrics/mAP50(B)"]), 4),
+        "map50_95": round(float(results["metrics/mAP50-95(B)"]), 4),
+    }
+
+
+def measure_latency(weights, imgsz, images, threads=None, runs=LATENCY_RUNS):
+    # CPU latency of one full-size image through the deployed PyTorch backend
+    from backends import create_backend
+
+    backend = create_backend(weights, "pytorch", threads)
+    backend.load()
+    backend.predict([images[0]], imgsz=imgsz, device="cpu")
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        backend.predict([images[i % len(images)]], imgsz=imgsz, device="cpu")
+        timings.append((time.perf_counter() - started) * 1000)
+    p50, p95 = np.percentile(timings, [50, 95])
+    return round(float(p50), 2), round(float(p95), 2)
+
+
+def dominates(a, b):
+    # a is at least as accurate and as fast as b, and better in one of the two
+    return (a["map50_95"] >= b["map50_95"] and a["latency_p50_ms"] <= b["latency_p50_ms"]
+            and (a["map50_95"] > b["map50_95"] or a["latency_p50_ms"] < b["latency_p50_ms"]))
+
+
+def sweep(data=DATA_YAML, models=SWEEP_MODELS, sizes=SWEEP_IMGSZ, epochs=EPOCHS, batch=BATCH, jobs=None,
+          project="runs/sweep", latency_images=8, max_latency_ms=None, report=SWEEP_REPORT):
+    cpus = os.cpu_count() or 1
+    jobs = jobs or max(1, min(len(models) * len(sizes), cpus // 4))
+    threads = max(1, cpus // jobs)
+    dataset = check_det_dataset(data)
+    # Caches are built once here, not raced for by the jobs
+    for imgsz in sizes:
+        for split in ("train", "val"):
+            prepare_cache(dataset[split], imgsz, dataset)
+    options = {"data": data, "epochs": epochs, "batch": batch, "project": os.path.abspath(project),
+               "workers": min(threads, 4)}
+    grid = [(model, imgsz, threads, options) for model in models for imgsz in sizes]
+    with ProcessPoolExecutor(jobs) as pool:
+        rows = list(pool.map(_sweep_job, grid))
+
+    # Timed one at a time after training so the runs do not slow each other down
+    val_dir = cache_dir_for(dataset["val"], sizes[0])
+    with open(os.path.join(val_dir, "index.json")) as f:
+        val_files = json.load(f)["im_files"][:latency_images]
+    images = [img for img in (cv2.imread(path) for path in val_files) if img is not None]
+    for row in rows:
+        row["latency_p50_ms"], row["latency_p95_ms"] = measure_latency(row["weights"], row["imgsz"], images, cpus)
+
+    for row in rows:
+        row["pareto"] = not any(dominates(other, row) for other in rows)
+    candidates = [row for row in rows
+                  if row["pareto"] and (max_latency_ms is None or row["latency_p50_ms"] <= max_latency_ms)]
+    best = max(candidates, key=lambda row: row["map50_95"]) if candidates else None
+    rows.sort(key=lambda row: row["latency_p50_ms"])
+    for row in rows:
+        print(f"{os.path.basename(row['model']):14s} imgsz={row['imgsz']:<4d} mAP50={row['map50']:.3f} "
+              f"mAP50-95={row['map50_95']:.3f} p50={row['latency_p50_ms']:7.1f} ms p95={row['latency_p95_ms']:7.1f} ms"
+              f"{'  *' if row['pareto'] else ''}")
+    if best:
+        print(f"Recommended: {best['weights']} (imgsz {best['imgsz']})")
+    with open(report, "w") as f:
+        json.dump({"jobs": jobs, "threads_per_job": threads, "epochs": epochs, "max_latency_ms": max_latency_ms,
+                   "recommended": best, "runs": rows}, f, indent=2)
+    print(f"Report written to {report}")
+    return rows, best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the caries detector from a preprocessed dataset cache.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = commands.add_parser("prepare", help="Build the image and label cache for every split")
+    prepare_parser.add_argument("--data", default=DATA_YAML)
+    prepare_parser.add_argument("--imgsz", type=int, nargs="+", default=[IMGSZ])
+
+    train_parser = commands.add_parser("train", help="Train one model from the cache")
+    train_parser.add_argument("--data", default=DATA_YAML)
+    train_parser.add_argument("--model", default=BASE_MODEL)
+    train_parser.add_argument("--epochs", type=int, default=EPOCHS)
+    train_parser.add_argument("--batch", type=int, default=BATCH)
+    train_parser.add_argument("--imgsz", type=int, default=IMGSZ)
+    train_parser.add_argument("--device", default=TRAIN_DEVICE)
+    train_parser.add_argument("--workers", type=int, default=8)
+
+    sweep_parser = commands.add_parser("sweep", help="Train every model size at every imgsz in parallel and "
+                                                     "report mAP against CPU latency")
+    sweep_parser.add_argument("--data", default=DATA_YAML)
+    sweep_parser.add_argument("--models", nargs="+", default=SWEEP_MODELS)
+    sweep_parser.add_argument("--imgsz", type=int, nargs="+", default=SWEEP_IMGSZ)
+    sweep_parser.add_argument("--epochs", type=int, default=EPOCHS)
+    sweep_parser.add_argument("--batch", type=int, default=BATCH)
+    sweep_parser.add_argument("--jobs", type=int, help="Runs trained at once (default: one per 4 CPUs)")
+    sweep_parser.add_argument("--project", default="runs/sweep")
+    sweep_parser.add_argument("--max-latency-ms", type=float, help="Recommend the best model under this latency")
+    sweep_parser.add_argument("--report", default=SWEEP_REPORT)
+    args = parser.parse_args(argv)
+
+    if args.command == "prepare":
+        dataset = check_det_dataset(args.data)
+        for imgsz in args.imgsz:
+            for split in ("train", "val"):
+                print(f"{split} @ {imgsz}: {prepare_cache(dataset[split], imgsz, dataset)}")
+    elif args.command == "train":
+        yolo, _ = train(args.data, args.model, args.epochs, args.imgsz, args.batch, args.device, workers=args.workers)
+        print(f"Best weights: {yolo.trainer.best}")
+    else:
+        sweep(args.data, args.models, args.imgsz, args.epochs, args.batch, args.jobs, args.project,
+              max_latency_ms=args.max_latency_ms, report=args.report)
 
-# Load model (use pre-trained weights or train from scratch)
-model = YOLO("yolov11n.pt")  # Choose a suitable model
 
 if __name__ == "__main__":
-    model.train(
-        data=r"C:\Users\muham\Documents\Caries_detection(3)\data.yaml",  # Path to dataset config
-        epochs=50,
-        batch=16,
-        imgsz=640,
-        device="cuda"  # Use 'cpu' if no GPU
-    )
\ No newline at end of file
+    main()
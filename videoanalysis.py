@@ -0,0 +1,96 @@
+import queue
+import threading
+import time
+
+import cv2
+
+from tracker import LesionTracker
+
+BATCH_SIZE = 8
+DECODE_QUEUE_SIZE = 2
+
+_END = object()
+
+
+def frame_stride(fps, stride=None, target_fps=None):
+    if stride:
+        return max(1, int(stride))
+    if target_fps and fps:
+        return max(1, round(fps / target_fps))
+    return 1
+
+
+def decode_batches(cap, stride, batch_size, stop=None):
+    # Skipped frames are only grabbed, never retrieved, so they are not converted
+    frame_index, indices, frames = 0, [], []
+    while stop is None or not stop.is_set():
+        if frame_index % stride:
+            if not cap.grab():
+                break
+        else:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            indices.append(frame_index)
+            frames.append(frame)
+            if len(frames) == batch_size:
+                yield indices, frames
+                indices, frames = [], []
+        frame_index += 1
+    if frames:
+        yield indices, frames
+
+
+def analyze_video(path, model, store, stride=None, target_fps=None, batch_size=BATCH_SIZE,
+                  progress=None, cancel=None, **predict_kwargs):
+    # Runs the whole file as fast as decode and inference allow. Decoding runs on its
+    # own thread, a couple of batches ahead of the model. Every sampled frame goes
+    # through the detector; the tracker only links the samples into lesions.
+    # progress is called with (frames decoded, total frames, eta seconds).
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Failed to open video {path}")
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    stride = frame_stride(cap.get(cv2.CAP_PROP_FPS), stride, target_fps)
+    batches = queue.Queue(maxsize=DECODE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def decode():
+        try:
+            for batch in decode_batches(cap, stride, batch_size, stop):
+                batches.put(batch)
+        finally:
+            batches.put(_END)
+
+    decoder = threading.Thread(target=decode, name="video-decode", daemon=True)
+    decoder.start()
+    started = time.perf_counter()
+    tracker = LesionTracker(next_id=store.next_track_id())
+    next_index = 0
+    batch = None
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _END:
+                store.mark_skipped(next_index, min(total, next_index + stride - 1))
+                break
+            if cancel is not None and cancel.is_set():
+                break
+            indices, frames = batch
+            for index, frame, detections in zip(indices, frames, model.predict(frames, **predict_kwargs)):
+                store.add(index, tracker.update(index, frame, detections))
+            # Frames between the samples were decoded past, not analyzed
+            store.mark_skipped(next_index, indices[-1])
+            next_index = indices[-1] + 1
+            if progress:
+                done = indices[-1] + 1
+                elapsed = time.perf_counter() - started
+                eta = elapsed / done * (total - done) if total > done else 0.0
+                progress(done, total, eta)
+    finally:
+        stop.set()
+        while batch is not _END:
+            batch = batches.get()
+        decoder.join()
+        cap.release()
+    return store